@@ -1,163 +1,472 @@
 
 import os
+import sys
+import errno
 import asyncio
+import re
+import ssl
 import logging
+import time
+import secrets
+import functools
 import subprocess
 import shutil
 import requests
 import aiohttp
 from urllib.parse import urlparse
 from pathlib import Path
+from types import MappingProxyType
 
 logger = logging.getLogger(__name__)
 
-class VideoDownloader:
+DEFAULT_HEADERS = MappingProxyType({
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'video/mp4,video/*,*/*;q=0.8'
+})
+# No overall cap on the shared session, so long transfers only abort when a
+# socket stalls; unreachable hosts and stalled sockets fail fast instead
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60)
+
+# Python before 3.12.7 (and 3.13.0) leaks half-closed TLS transports, which
+# aiohttp's enable_cleanup_closed works around; on fixed versions aiohttp
+# ignores the flag with a DeprecationWarning, so only pass it where it matters
+NEEDS_CLEANUP_CLOSED = sys.version_info < (3, 12, 7) or (3, 13, 0) <= sys.version_info < (3, 13, 1)
+
+# Already-compressed video containers are fetched without transport encoding;
+# anything else (playlists, subtitles, HTML error pages) may be gzipped
+VIDEO_EXTS = frozenset({'.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm'})
+
+# Read size for streamed downloads (1 MiB keeps the Python loop off the hot path)
+CHUNK_SIZE = 1 << 20
+
+INV_MB = 1.0 / (1024 * 1024)
+
+# Minimum seconds between progress messages to avoid Telegram rate limits
+PROGRESS_INTERVAL = 3
+
+# aria2c JSON-RPC daemon settings
+ARIA2_RPC_PORT = int(os.getenv('ARIA2_RPC_PORT', '6800'))
+ARIA2_RPC_URL = f"http://127.0.0.1:{ARIA2_RPC_PORT}/jsonrpc"
+ARIA2_RPC_TIMEOUT = aiohttp.ClientTimeout(total=10)
+ARIA2_POLL_INTERVAL = 1
+ARIA2_STATUS_KEYS = ['status', 'totalLength', 'completedLength', 'downloadSpeed', 'errorCode', 'errorMessage']
+
+# Files smaller than this are not worth aria2c's multi-connection setup
+ARIA2_MIN_SIZE = 32 * 1024 * 1024
+
+# Parallel connections per aria2c download, and the fallback used when a server
+# rejects them (network problem, resume unsupported, bad HTTP response, overloaded)
+ARIA2_MAX_SPLITS = int(os.getenv('ARIA2_MAX_SPLITS', '16'))
+ARIA2_FALLBACK_SPLITS = 8
+ARIA2_SPLIT_ERRORS = frozenset({'6', '8', '22', '29'})
+
+# Built-in ranged download used when aria2c is not installed: at most this many
+# parallel parts, each covering at least RANGE_MIN_PART_SIZE bytes
+RANGE_MAX_PARTS = int(os.getenv('RANGE_MAX_PARTS', '8'))
+RANGE_MIN_PART_SIZE = 8 * 1024 * 1024
+
+# HEAD probe settings; these statuses often mean only HEAD is refused
+# (e.g. presigned URLs signed for GET), so they do not rule out a download
+PROBE_TIMEOUT = aiohttp.ClientTimeout(total=10)
+PROBE_INCONCLUSIVE_STATUSES = frozenset({403, 405})
+
+# Subprocess output is read in blocks and split on either line terminator
+STDERR_READ_SIZE = 4096
+
+# Only this much trailing stderr is kept for failure logs
+STDERR_TAIL_SIZE = 16 * 1024
+STDERR_TAIL_LINES = 10
+_EOL_RE = re.compile(rb'[\r\n]')
+
+# Content-Range of a 206 response, e.g. "bytes 0-1023/4096"
+_CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+# wget progress bar, e.g. "clip.mp4   15%[==>      ]  42.95M  50.0MB/s"
+_WGET_PROGRESS_RE = re.compile(rb'(?P<pct>\d+)%\s*\[[^\]]*\]\s+(?P<done>[\d.,]+[KMGT]?)\s+(?P<speed>\S+/s)')
+
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
+def format_size(bytes_size, precision=1, units=_SIZE_UNITS):
+    """Format bytes to human readable format, e.g. 1.5MB"""
+    # Every unit is 2**10 of the previous one, so bit_length() picks it directly
+    index = min(max(int(bytes_size).bit_length() - 1, 0) // 10, len(units) - 1)
+    return f"{bytes_size / (1 << (10 * index)):.{precision}f}{units[index]}"
+
+class _ThrottledProgress:
+    """Rate-limit progress messages sent to a callback"""
+    def __init__(self, callback, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self._next_tick = 0.0
+        self._last_message = None
+    
+    def due(self):
+        """Check whether the next update may be sent"""
+        return self.callback is not None and time.monotonic() >= self._next_tick
+    
+    async def send(self, message):
+        """Send message unless it repeats the previous one"""
+        if message == self._last_message:
+            return
+        await self.callback(message)
+        self._last_message = message
+        self._next_tick = time.monotonic() + self.interval
+
+class _AsyncLatest:
+    """Single-slot mailbox that only keeps the most recent value"""
     def __init__(self):
+        self._value = None
+        self._ready = asyncio.Event()
+        self._closed = asyncio.Event()
+    
+    @property
+    def closed(self):
+        return self._closed.is_set()
+    
+    def set(self, value):
+        """Store value, replacing any value not yet consumed"""
+        self._value = value
+        self._ready.set()
+    
+    async def report(self, value):
+        """Awaitable form of set() for code expecting an async callback"""
+        self.set(value)
+    
+    def close(self):
+        """Let the consumer finish once the last value is delivered"""
+        self._closed.set()
+        self._ready.set()
+    
+    async def get(self):
+        """Wait for the next value; returns None once closed and empty"""
+        await self._ready.wait()
+        if not self.closed:
+            self._ready.clear()
+        value, self._value = self._value, None
+        return value
+    
+    async def wait_closed(self, timeout):
+        """Wait up to timeout seconds for close()"""
+        try:
+            await asyncio.wait_for(self._closed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def _drain_progress(latest, callback, interval=PROGRESS_INTERVAL):
+    """Forward the latest progress message to callback, at most once per interval"""
+    while True:
+        message = await latest.get()
+        if message is None:
+            if latest.closed:
+                return
+            continue
+        
+        try:
+            await callback(message)
+        except Exception as e:
+            logger.debug(f"Progress callback error: {e}")
+        
+        if not latest.closed:
+            await latest.wait_closed(interval)
+
+@functools.lru_cache(maxsize=None)
+def find_tool(name):
+    """Locate an executable on PATH, scanning it only once per process"""
+    return shutil.which(name)
+
+@functools.lru_cache(maxsize=1024)
+def _default_filename(filename):
+    """Fall back to video.mp4 when filename has no extension; any extension, even .zip, is kept"""
+    if not os.path.splitext(filename)[1]:
+        return "video.mp4"
+    return filename
+
+@functools.lru_cache(maxsize=1024)
+def get_filename_from_url(url):
+    """Extract filename from URL (cached, since fallbacks and retries repeat it)"""
+    parsed_url = urlparse(url)
+    return _default_filename(os.path.basename(parsed_url.path))
+
+def _write_all(fd, data):
+    """Write data to a file descriptor, retrying on short writes"""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+def _pwrite_all(fd, data, offset):
+    """Write data at offset in a file descriptor, retrying on short writes"""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+def _format_tail(data, max_lines=STDERR_TAIL_LINES):
+    """Return the last non-empty lines of captured subprocess output"""
+    lines = [line.strip() for line in _EOL_RE.split(bytes(data)) if line.strip()]
+    return b'\n'.join(lines[-max_lines:]).decode('utf-8', errors='ignore')
+
+def _preallocate(fd, size):
+    """Reserve size bytes for fd up front so the file is not grown write by write"""
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            # macOS/BSD: at least set the final length in one call
+            os.ftruncate(fd, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            # The file cannot fit; fail now rather than after most of the transfer
+            raise
+        logger.debug(f"Preallocation skipped: {e}")
+
+def _fadvise(fd, advice):
+    """Pass a page-cache hint for the whole file where the OS supports it"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError as e:
+            logger.debug(f"posix_fadvise skipped: {e}")
+
+def _drop_page_cache(file_path):
+    """Ask the kernel to evict a finished download from the page cache"""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        _fadvise(fd, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+class VideoDownloader:
+    def __init__(self, verify_ssl=False):
         self.download_dir = Path("downloads")
         self.download_dir.mkdir(exist_ok=True)
+        self.verify_ssl = verify_ssl
+        self._session = None
+        self._connector = None
+        
+        # One SSL context for every connection instead of a per-request default
+        self._ssl_ctx = ssl.create_default_context()
+        if not verify_ssl:
+            self._ssl_ctx.check_hostname = False
+            self._ssl_ctx.verify_mode = ssl.CERT_NONE
+        self._aria2_process = None
+        # Queue workers can need the daemon at the same moment; only one may start it
+        self._aria2_lock = asyncio.Lock()
+        self._aria2_secret = secrets.token_hex(16)
+        self.max_splits = ARIA2_MAX_SPLITS
+        # Paths owned by in-flight downloads, released by cleanup_file_async()
+        self._active_paths = set()
+        # Sizes of files in download_dir, kept current as downloads finish and
+        # are deleted so /status needs no directory walk; None until first scan
+        self._file_sizes = None
+        self._stored_bytes = 0
+    
+    async def get_session(self):
+        """Get the shared aiohttp session, creating it on first use"""
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                ssl=self._ssl_ctx,
+                limit=64,
+                limit_per_host=8,
+                ttl_dns_cache=300,  # Skip DNS for repeat hosts
+                keepalive_timeout=75,  # Keep sockets warm between queue items
+                enable_cleanup_closed=NEEDS_CLEANUP_CLOSED
+            )
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=DEFAULT_TIMEOUT,
+                headers=DEFAULT_HEADERS,
+                connector=self._connector,
+                connector_owner=False
+            )
+        return self._session
+    
+    async def close(self):
+        """Stop the aria2c daemon and close the shared aiohttp session"""
+        await self._stop_aria2_daemon()
+        if self._session and not self._session.closed:
+            await self._session.close()
+        if self._connector and not self._connector.closed:
+            await self._connector.close()
+        self._session = None
+        self._connector = None
     
-    def get_filename_from_url(self, url):
-        """Extract filename from URL"""
-        parsed_url = urlparse(url)
-        filename = os.path.basename(parsed_url.path)
+    async def _aria2_call(self, method, *params):
+        """Call an aria2c JSON-RPC method and return its result"""
+        session = await self.get_session()
+        payload = {
+            'jsonrpc': '2.0',
+            'id': 'downloader',
+            'method': method,
+            'params': [f'token:{self._aria2_secret}', *params]
+        }
         
-        # If no filename found, create a default one
-        if not filename or '.' not in filename:
-            filename = "video.mp4"
+        async with session.post(ARIA2_RPC_URL, json=payload, timeout=ARIA2_RPC_TIMEOUT) as response:
+            data = await response.json(content_type=None)
         
-        return filename
+        if 'error' in data:
+            raise RuntimeError(f"aria2 {method} failed: {data['error'].get('message')}")
+        return data['result']
     
-    async def download_with_aria2c(self, url, file_path, progress_callback=None):
-        """Download using aria2c with progress tracking"""
-        try:
-            if progress_callback:
-                await progress_callback("🚀 Starting aria2c download...")
-            
-            # aria2c command with optimized settings for large files
+    async def _ensure_aria2_daemon(self):
+        """Start the aria2c RPC daemon if it is not already running"""
+        async with self._aria2_lock:
+            if self._aria2_process and self._aria2_process.returncode is None:
+                return True
+
             cmd = [
                 'aria2c',
+                '--enable-rpc=true',
+                '--rpc-listen-all=false',  # Only accept local RPC clients
+                f'--rpc-listen-port={ARIA2_RPC_PORT}',
+                f'--rpc-secret={self._aria2_secret}',
+                f'--stop-with-process={os.getpid()}',  # Never outlive the bot
+                '--max-download-result=50',
                 '--continue=true',  # Resume downloads
                 '--max-tries=5',    # Retry failed downloads
                 '--retry-wait=3',   # Wait between retries
                 '--timeout=60',     # Connection timeout
-                '--split=8',        # Use 8 connections
-                '--max-connection-per-server=8',
-                '--min-split-size=1M',  # Minimum split size
-                '--file-allocation=none',  # Faster start
-                '--check-certificate=false',  # Skip SSL cert check
-                '--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                '--header=Accept: video/mp4,video/*,*/*;q=0.8',
-                '--dir=' + str(self.download_dir),
-                '--out=' + os.path.basename(file_path),
-                '--summary-interval=3',  # Progress update interval (reduced frequency)
-                url
+                '--file-allocation=falloc',  # Reserve the whole file in one call
+                '--optimize-concurrent-downloads=true',
+                '--async-dns=true',
+                '--disk-cache=64M',  # Buffer pieces in memory before hitting disk
+                f'--check-certificate={str(self.verify_ssl).lower()}',
+                '--user-agent=' + DEFAULT_HEADERS['User-Agent'],
+                '--quiet=true'
             ]
-            
-            logger.info(f"Running aria2c command: {' '.join(cmd)}")
-            
-            # Run aria2c with real-time progress tracking and timeout
+
+            logger.info("Starting aria2c RPC daemon")
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+            self._aria2_process = process
+
+            # Wait for the RPC endpoint to come up
+            for _ in range(20):
+                if process.returncode is not None:
+                    break
+                try:
+                    await self._aria2_call('aria2.getVersion')
+                    logger.info(f"aria2c RPC daemon listening on port {ARIA2_RPC_PORT}")
+                    return True
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    await asyncio.sleep(0.25)
+                except Exception as e:
+                    logger.error(f"aria2c RPC daemon rejected request: {e}")
+                    break
+
+            logger.error("aria2c RPC daemon failed to start")
+            await self._stop_aria2_daemon(process)
+            return False
+    
+    async def _stop_aria2_daemon(self, process=None):
+        """Terminate the aria2c RPC daemon, or only the given process if passed"""
+        process = process or self._aria2_process
+        if process and process.returncode is None:
             try:
-                process = await asyncio.wait_for(
-                    asyncio.create_subprocess_exec(
-                        *cmd,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    ),
-                    timeout=5.0
-                )
+                process.terminate()
+                await asyncio.wait_for(process.wait(), timeout=10)
             except asyncio.TimeoutError:
-                logger.error("aria2c process creation timed out")
-                return False
-            
-            # Track progress with timeout and throttling
-            last_progress = ""
-            last_update_time = 0
-            import time
-            
-            try:
-                while True:
-                    try:
-                        line = await asyncio.wait_for(process.stderr.readline(), timeout=2.0)
-                        if not line:
-                            break
-                        
-                        line = line.decode('utf-8', errors='ignore').strip()
-                        current_time = time.time()
-                        
-                        # Only update progress every 3 seconds to avoid rate limits
-                        if line and progress_callback and (current_time - last_update_time) >= 3:
-                            # Parse aria2c progress output
-                            if '[#' in line and '%]' in line:
-                                try:
-                                    # Extract detailed progress info
-                                    percentage = "0"
-                                    downloaded_size = "0B"
-                                    total_size = "Unknown"
-                                    speed = "0B/s"
-                                    
-                                    # Extract percentage
-                                    if '(' in line and '%)' in line:
-                                        start = line.find('(') + 1
-                                        end = line.find('%)')
-                                        if end > start:
-                                            percentage = line[start:end]
-                                    
-                                    # Extract downloaded/total size
-                                    if 'MiB' in line or 'GiB' in line or 'KiB' in line:
-                                        parts = line.split()
-                                        for i, part in enumerate(parts):
-                                            if 'MiB' in part or 'GiB' in part or 'KiB' in part:
-                                                if i > 0:
-                                                    downloaded_size = parts[i-1] + part
-                                                if '/' in part and i < len(parts) - 1:
-                                                    total_size = parts[i+1] if i+1 < len(parts) else "Unknown"
-                                                break
-                                    
-                                    # Extract speed
-                                    if 'DL:' in line:
-                                        speed_start = line.find('DL:') + 3
-                                        speed_parts = line[speed_start:].split()
-                                        if speed_parts:
-                                            speed = speed_parts[0]
-                                    
-                                    progress_msg = f"📥 Downloading: {percentage}%\n💾 Data: {downloaded_size} / {total_size}\n🚄 Speed: {speed}"
-                                    
-                                    if progress_msg != last_progress:
-                                        await progress_callback(progress_msg)
-                                        last_progress = progress_msg
-                                        last_update_time = current_time
-                                except Exception as parse_error:
-                                    logger.debug(f"Progress parse error: {parse_error}")
-                                    pass
-                    except asyncio.TimeoutError:
-                        # Continue if readline times out
-                        continue
-            except Exception as e:
-                logger.error(f"Error reading aria2c output: {e}")
+                process.kill()
+            except ProcessLookupError:
+                pass
+        # Don't forget a daemon some other caller has started since
+        if self._aria2_process is process:
+            self._aria2_process = None
+    
+    async def download_with_aria2c(self, url, file_path, progress_callback=None):
+        """Download through the aria2c RPC daemon with progress tracking"""
+        try:
+            if progress_callback:
+                await progress_callback("🚀 Starting aria2c download...")
             
-            # Wait for process to complete with timeout
-            try:
-                await asyncio.wait_for(process.wait(), timeout=300)  # 5 minute timeout
-            except asyncio.TimeoutError:
-                logger.error("aria2c process timed out")
-                try:
-                    process.kill()
-                except:
-                    pass
+            if not await self._ensure_aria2_daemon():
                 return False
             
-            if process.returncode == 0:
-                logger.info("aria2c download completed successfully")
-                return True
-            else:
-                stderr_output = await process.stderr.read()
-                logger.error(f"aria2c failed with code {process.returncode}: {stderr_output.decode()}")
-                return False
+            throttle = _ThrottledProgress(progress_callback)
+            splits = self.max_splits
+            
+            while True:
+                success, error_code = await self._aria2_transfer(url, file_path, splits, throttle)
+                if success or splits <= ARIA2_FALLBACK_SPLITS or error_code not in ARIA2_SPLIT_ERRORS:
+                    return success
+                
+                # Some servers reject many parallel ranges; retry with fewer connections
+                logger.warning(f"aria2c error {error_code} with {splits} connections, retrying with {ARIA2_FALLBACK_SPLITS}")
+                splits = ARIA2_FALLBACK_SPLITS
                 
         except Exception as e:
             logger.error(f"aria2c download failed: {e}")
             return False
     
+    async def _aria2_transfer(self, url, file_path, splits, throttle):
+        """Run one aria2c download and return (success, error_code)"""
+        gid = None
+        finished = False
+        try:
+            # Per-download options tuned for large files
+            options = {
+                'dir': str(self.download_dir),
+                'out': os.path.basename(file_path),
+                'split': str(splits),
+                'max-connection-per-server': str(splits),
+                'min-split-size': '4M',  # Larger contiguous ranges per connection
+                'piece-length': '1M',
+                'stream-piece-selector': 'inorder',
+                'header': ['Accept: ' + DEFAULT_HEADERS['Accept']]
+            }
+            
+            gid = await self._aria2_call('aria2.addUri', [url], options)
+            logger.info(f"aria2c download started: {url} (gid {gid}, {splits} connections)")
+            
+            # Poll structured status instead of scraping console output
+            while True:
+                status = await self._aria2_call('aria2.tellStatus', gid, ARIA2_STATUS_KEYS)
+                state = status['status']
+                
+                if state == 'complete':
+                    finished = True
+                    logger.info("aria2c download completed successfully")
+                    return True, None
+                
+                if state in ('error', 'removed'):
+                    finished = True
+                    logger.error(f"aria2c failed with code {status.get('errorCode')}: {status.get('errorMessage')}")
+                    return False, status.get('errorCode')
+                
+                if throttle.due():
+                    completed = int(status['completedLength'])
+                    total = int(status['totalLength'])
+                    speed = int(status['downloadSpeed'])
+                    percentage = completed * 100 // total if total else 0
+                    total_str = format_size(total) if total else "Unknown"
+                    
+                    progress_msg = f"📥 Downloading: {percentage}%\n💾 Data: {format_size(completed)} / {total_str}\n🚄 Speed: {format_size(speed)}/s"
+                    await throttle.send(progress_msg)
+                
+                await asyncio.sleep(ARIA2_POLL_INTERVAL)
+        finally:
+            if gid:
+                await self._aria2_discard(gid, finished)
+    
+    async def _aria2_discard(self, gid, finished):
+        """Drop a download from the aria2c daemon, stopping it if still active"""
+        try:
+            if finished:
+                await self._aria2_call('aria2.removeDownloadResult', gid)
+            else:
+                await self._aria2_call('aria2.forceRemove', gid)
+        except Exception as e:
+            logger.debug(f"Could not discard aria2c download {gid}: {e}")
+    
     async def download_with_wget(self, url, file_path, progress_callback=None):
         """Download using wget as fallback"""
         try:
@@ -169,75 +478,58 @@ class VideoDownloader:
                 '--continue',  # Resume downloads
                 '--tries=3',   # Reduce retry attempts
                 '--timeout=30',  # Reduce timeout
-                '--user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                '--header=Accept: video/mp4,video/*,*/*;q=0.8',
-                '--no-check-certificate',  # Skip SSL cert check
+                '--user-agent=' + DEFAULT_HEADERS['User-Agent'],
+                '--header=Accept: ' + DEFAULT_HEADERS['Accept'],
                 '--progress=bar:force',  # Force progress bar
                 '-O', str(file_path),
                 url
             ]
             
+            if not self.verify_ssl:
+                cmd.insert(-1, '--no-check-certificate')  # Skip SSL cert check
+            
             logger.info(f"Running wget command: {' '.join(cmd)}")
             
-            # Add timeout to prevent hanging
-            try:
-                process = await asyncio.wait_for(
-                    asyncio.create_subprocess_exec(
-                        *cmd,
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    ),
-                    timeout=5.0
-                )
-            except asyncio.TimeoutError:
-                logger.error("wget process creation timed out")
-                return False
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
             
             # Track wget progress with timeout and throttling
-            last_progress = ""
-            last_update_time = 0
-            import time
+            throttle = _ThrottledProgress(progress_callback)
             
+            stderr_tail = bytearray()
             try:
+                buffer = b''
                 while True:
-                    try:
-                        line = await asyncio.wait_for(process.stderr.readline(), timeout=2.0)
-                        if not line:
-                            break
-                        
-                        line = line.decode('utf-8', errors='ignore').strip()
-                        current_time = time.time()
-                        
-                        # Only update progress every 3 seconds to avoid rate limits
-                        if line and progress_callback and '%' in line and (current_time - last_update_time) >= 3:
-                            try:
-                                # Parse wget detailed progress
-                                percentage = "0"
-                                downloaded_size = "0K"
-                                speed = "0K/s"
-                                
-                                parts = line.split()
-                                for i, part in enumerate(parts):
-                                    if '%' in part:
-                                        percentage = part.replace('%', '')
-                                    elif 'K' in part or 'M' in part or 'G' in part:
-                                        if i > 0 and not '%' in parts[i-1]:
-                                            downloaded_size = part
-                                    elif '/s' in part:
-                                        speed = part
-                                
+                    # Block until output arrives instead of waking up on a timer
+                    data = await process.stderr.read(STDERR_READ_SIZE)
+                    if not data:
+                        break
+                    
+                    stderr_tail += data
+                    del stderr_tail[:-STDERR_TAIL_SIZE]
+                    
+                    # wget redraws its bar with carriage returns, so split on both
+                    *lines, buffer = _EOL_RE.split(buffer + data)
+                    
+                    # Only parse the newest progress line when an update is due
+                    if lines and throttle.due():
+                        for line in reversed(lines):
+                            match = _WGET_PROGRESS_RE.search(line)
+                            if match:
+                                percentage, downloaded_size, speed = (
+                                    field.decode() for field in match.group('pct', 'done', 'speed')
+                                )
                                 progress_msg = f"📥 Downloading: {percentage}%\n💾 Downloaded: {downloaded_size}\n🚄 Speed: {speed}"
-                                
-                                if progress_msg != last_progress:
-                                    await progress_callback(progress_msg)
-                                    last_progress = progress_msg
-                                    last_update_time = current_time
-                            except Exception as parse_error:
-                                logger.debug(f"Progress parse error: {parse_error}")
-                                pass
-                    except asyncio.TimeoutError:
-                        # Continue if readline times out
-                        continue
+                                await throttle.send(progress_msg)
+                                break
+            except asyncio.CancelledError:
+                # Don't leave wget running when the download is abandoned
+                if process.returncode is None:
+                    process.kill()
+                raise
             except Exception as e:
                 logger.error(f"Error reading wget output: {e}")
             
@@ -248,8 +540,7 @@ class VideoDownloader:
                     logger.info("wget download completed successfully")
                     return True
                 else:
-                    stderr_output = await process.stderr.read()
-                    logger.error(f"wget failed with code {process.returncode}: {stderr_output.decode()}")
+                    logger.error(f"wget failed with code {process.returncode} (stderr tail):\n{_format_tail(stderr_tail)}")
                     return False
             except asyncio.TimeoutError:
                 logger.error("wget process timed out")
@@ -269,71 +560,317 @@ class VideoDownloader:
             if progress_callback:
                 await progress_callback("🔄 Trying with Python requests...")
             
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Accept': 'video/mp4,video/*,*/*;q=0.8'
-            }
-            
             logger.info(f"Downloading with requests: {url}")
             
-            # Use aiohttp for async download
-            async with aiohttp.ClientSession(
-                timeout=aiohttp.ClientTimeout(total=1800),  # 30 minute timeout
-                headers=headers
-            ) as session:
-                async with session.get(url, ssl=False) as response:
-                    if response.status != 200:
-                        logger.error(f"HTTP {response.status}: {response.reason}")
-                        return False
-                    
-                    total_size = int(response.headers.get('content-length', 0))
-                    downloaded = 0
-                    last_update_time = 0
-                    import time
+            # Use the shared aiohttp session so keep-alive connections are reused
+            session = await self.get_session()
+            headers = None
+            if os.path.splitext(file_path)[1].lower() in VIDEO_EXTS:
+                headers = {'Accept-Encoding': 'identity'}
+            
+            async with session.get(url, headers=headers) as response:
+                response.raise_for_status()
+                
+                total_size = int(response.headers.get('content-length', 0))
+                downloaded = 0
+                throttle = _ThrottledProgress(progress_callback)
+                
+                # Per-download constants, so each progress tick only formats the changing parts
+                total_str = format_size(total_size)
+                percent_scale = 100.0 / total_size if total_size > 0 else 0.0
+                
+                # Write chunks straight to the file descriptor (no extra buffer copy)
+                fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+                        _fadvise(fd, os.POSIX_FADV_SEQUENTIAL)
                     
-                    def format_size(bytes_size):
-                        """Format bytes to human readable format"""
-                        for unit in ['B', 'KB', 'MB', 'GB']:
-                            if bytes_size < 1024.0:
-                                return f"{bytes_size:.1f}{unit}"
-                            bytes_size /= 1024.0
-                        return f"{bytes_size:.1f}TB"
+                    # Content-Length is only the on-disk size when the body isn't encoded
+                    preallocated = total_size > 0 and response.headers.get('Content-Encoding', 'identity') == 'identity'
+                    if preallocated:
+                        _preallocate(fd, total_size)
                     
-                    with open(file_path, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(8192):
-                            f.write(chunk)
-                            downloaded += len(chunk)
-                            current_time = time.time()
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        _write_all(fd, chunk)
+                        downloaded += len(chunk)
+                        
+                        # Only build the progress message when an update is due
+                        if throttle.due():
+                            downloaded_str = format_size(downloaded)
                             
-                            # Only update progress every 3 seconds to avoid rate limits
-                            if progress_callback and total_size > 0 and (current_time - last_update_time) >= 3:
-                                progress = (downloaded / total_size) * 100
-                                downloaded_str = format_size(downloaded)
-                                total_str = format_size(total_size)
-                                
+                            if total_size > 0:
+                                progress = downloaded * percent_scale
                                 progress_msg = f"📥 Downloading: {progress:.1f}%\n💾 Data: {downloaded_str} / {total_str}"
-                                await progress_callback(progress_msg)
-                                last_update_time = current_time
-                    
-                    logger.info("Python requests download completed successfully")
-                    return True
+                            else:
+                                # No Content-Length (e.g. chunked responses): report bytes only
+                                progress_msg = f"📥 Downloading...\n💾 Data: {downloaded_str}"
+                            await throttle.send(progress_msg)
                     
+                    if preallocated and downloaded != total_size:
+                        # Don't leave a full-size file behind for a short body
+                        os.ftruncate(fd, downloaded)
+                        logger.error(f"Incomplete download: got {downloaded} of {total_size} bytes")
+                        return False
+                finally:
+                    os.close(fd)
+                
+                logger.info("Python requests download completed successfully")
+                return True
+                
         except Exception as e:
             logger.error(f"Python requests download failed: {e}")
             return False
     
+    async def download_with_ranges(self, url, file_path, progress_callback=None, probe=None):
+        """Download using parallel HTTP range requests written at their offsets
+
+        probe is the _probe() result if the caller already has one.
+        """
+        try:
+            if progress_callback:
+                await progress_callback("🔄 Trying with parallel range requests...")
+            
+            status, total_size, accept_ranges, _, validator = probe or await self._probe(url)
+            if not (200 <= status < 300 and accept_ranges == 'bytes' and total_size > 0):
+                logger.info(f"Range requests not supported for {url}")
+                return False
+            
+            part_count = max(1, min(RANGE_MAX_PARTS, total_size // RANGE_MIN_PART_SIZE))
+            part_size = -(-total_size // part_count)
+            logger.info(f"Downloading with {part_count} range requests: {url}")
+            
+            session = await self.get_session()
+            downloaded = 0
+            throttle = _ThrottledProgress(progress_callback)
+            total_str = format_size(total_size)
+            percent_scale = 100.0 / total_size
+            
+            async def fetch_part(start, end):
+                nonlocal downloaded
+                headers = {'Range': f'bytes={start}-{end}', 'Accept-Encoding': 'identity'}
+                if validator:
+                    # A changed file comes back as a full 200 instead of mixing versions
+                    headers['If-Range'] = validator
+                async with session.get(url, headers=headers) as response:
+                    if response.status != 206:
+                        raise RuntimeError(f"range {start}-{end} returned HTTP {response.status}")
+                    match = _CONTENT_RANGE_RE.fullmatch(response.headers.get('Content-Range', ''))
+                    if (
+                        not match
+                        or int(match[1]) != start
+                        or match[3] not in ('*', str(total_size))
+                    ):
+                        raise RuntimeError(
+                            f"range {start}-{end} answered with Content-Range "
+                            f"{response.headers.get('Content-Range')!r}"
+                        )
+                    
+                    offset = start
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        _pwrite_all(fd, chunk, offset)
+                        offset += len(chunk)
+                        downloaded += len(chunk)
+                        
+                        if throttle.due():
+                            progress = downloaded * percent_scale
+                            await throttle.send(
+                                f"📥 Downloading: {progress:.1f}% ({part_count} connections)\n"
+                                f"💾 Data: {format_size(downloaded)} / {total_str}"
+                            )
+                    
+                    if offset != end + 1:
+                        raise RuntimeError(f"range {start}-{end} ended after {offset - start} bytes")
+            
+            fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                _preallocate(fd, total_size)
+                tasks = [
+                    asyncio.create_task(fetch_part(start, min(start + part_size, total_size) - 1))
+                    for start in range(0, total_size, part_size)
+                ]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    # One failed part fails the download; stop the others
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+            finally:
+                os.close(fd)
+            
+            logger.info("Range download completed successfully")
+            return True
+            
+        except Exception as e:
+            logger.error(f"Range download failed: {e}")
+            return False
+    
     def check_tools_availability(self):
         """Check if aria2c and wget are available"""
-        aria2c_available = shutil.which('aria2c') is not None
-        wget_available = shutil.which('wget') is not None
+        aria2c_available = find_tool('aria2c') is not None
+        wget_available = find_tool('wget') is not None
         
         logger.info(f"aria2c available: {aria2c_available}")
         logger.info(f"wget available: {wget_available}")
         
         return aria2c_available, wget_available
     
-    async def download_video(self, url, timeout=1800, progress_callback=None):
-        """Download video using aria2c with wget fallback"""
+    async def download_video(self, url, timeout=None, progress_callback=None, race=False, backend=None):
+        """Download video using aria2c with wget fallback
+
+        There is no overall deadline unless timeout (seconds) is given; a
+        stalled transfer is caught by the aiohttp sock_read timeout and the
+        --timeout options of aria2c and wget instead. With race=True
+        all suitable backends run at once and the first to finish wins; this
+        trades extra bandwidth for lower latency. Pass backend='aria2c',
+        'wget', 'ranges' or 'requests' to skip backend selection.
+        """
+        latest = drainer = report = None
+        if progress_callback:
+            # Backends only drop messages into a single slot; a background task
+            # forwards the newest one so slow UI edits never stall the transfer
+            latest = _AsyncLatest()
+            drainer = asyncio.create_task(_drain_progress(latest, progress_callback))
+            report = latest.report
+        
+        try:
+            return await asyncio.wait_for(self._download_video(url, report, race, backend), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Download timed out after {timeout}s: {url}")
+            if report:
+                await report(f"❌ Download timed out after {timeout} seconds")
+            return None
+        finally:
+            if latest:
+                latest.close()
+                await drainer
+    
+    async def _probe(self, url):
+        """Send a HEAD request and return (status, length, accept_ranges, content_type, validator)
+
+        validator is a strong ETag or else the Last-Modified date, usable in If-Range.
+        """
+        session = await self.get_session()
+        async with session.head(url, allow_redirects=True, timeout=PROBE_TIMEOUT) as response:
+            try:
+                length = int(response.headers.get('Content-Length', 0))
+            except ValueError:
+                length = 0
+            validator = response.headers.get('ETag', '')
+            if validator.startswith('W/'):
+                # If-Range only accepts strong ETags
+                validator = ''
+            return (
+                response.status,
+                length,
+                response.headers.get('Accept-Ranges', '').lower(),
+                response.headers.get('Content-Type', ''),
+                validator or response.headers.get('Last-Modified', '')
+            )
+    
+    def _get_backend(self, backend, probe=None):
+        """Look up a download backend by name, returning (label, method)"""
+        backends = {
+            'aria2c': ('aria2c', self.download_with_aria2c),
+            'wget': ('wget', self.download_with_wget),
+            # Reuses the probe instead of sending its own HEAD request
+            'ranges': ('parallel range requests', functools.partial(self.download_with_ranges, probe=probe)),
+            'requests': ('Python requests', self.download_with_requests)
+        }
+        if backend not in backends:
+            raise ValueError(f"Unknown download backend: {backend}")
+        return backends[backend]
+    
+    def _plan_backends(self, probe, aria2c_available, wget_available):
+        """Pick the download backends to try, in order"""
+        if probe and 200 <= probe[0] < 300:
+            status, length, accept_ranges, content_type, _ = probe
+            # Multi-connection downloads only pay off for large ranged files
+            if accept_ranges == 'bytes' and length > ARIA2_MIN_SIZE:
+                parallel = 'aria2c' if aria2c_available else 'ranges'
+                return [self._get_backend(parallel, probe), self._get_backend('requests')]
+            return [self._get_backend('requests')]
+        
+        # Probe was inconclusive, so try everything that is installed
+        backends = []
+        if aria2c_available:
+            backends.append(self._get_backend('aria2c'))
+        if wget_available:
+            backends.append(self._get_backend('wget'))
+        backends.append(self._get_backend('requests'))
+        return backends
+    
+    async def _race_backends(self, url, file_path, backends, progress_callback=None):
+        """Run every backend at once and keep the first complete file"""
+        parts = {}
+        for index, (name, backend) in enumerate(backends):
+            part_path = file_path.with_name(f"{file_path.name}.{index}.part")
+            task = asyncio.create_task(backend(url, part_path, progress_callback))
+            parts[task] = (name, part_path)
+        
+        winner = None
+        pending = set(parts)
+        try:
+            while pending and not winner:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name, part_path = parts[task]
+                    if task.exception() is None and task.result() and part_path.exists():
+                        os.replace(part_path, file_path)
+                        winner = name
+                        break
+        finally:
+            # Stop the losers and remove their partial files
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for name, part_path in parts.values():
+                part_path.unlink(missing_ok=True)
+                self._untrack_file(part_path)
+                part_path.with_name(part_path.name + '.aria2').unlink(missing_ok=True)
+        
+        return winner
+    
+    async def _finish_download(self, name, file_path, progress_callback=None):
+        """Log and report a completed download"""
+        size = file_path.stat().st_size
+        self._track_file(file_path, size)
+        size_mb = size * INV_MB
+        # The file is read once more for the upload and then deleted, so don't
+        # let it push other data out of the page cache on small hosts
+        _drop_page_cache(file_path)
+        logger.info(f"Download completed with {name}: {file_path} ({size_mb:.2f} MB)")
+        if progress_callback:
+            await progress_callback(f"✅ Download completed! ({size_mb:.1f} MB)")
+        return str(file_path)
+    
+    def _reserve_path(self, filename):
+        """Pick a download path that no other in-flight download is using"""
+        stem, ext = os.path.splitext(filename)
+        file_path = self.download_dir / filename
+        index = 1
+        while file_path in self._active_paths:
+            file_path = self.download_dir / f"{stem}_{index}{ext}"
+            index += 1
+        self._active_paths.add(file_path)
+        return file_path
+    
+    def release_path(self, file_path):
+        """Free a finished download's path for reuse without deleting the file"""
+        self._active_paths.discard(Path(file_path))
+    
+    def _discard_partial(self, file_path):
+        """Delete what a failed download left behind and release its path"""
+        if file_path is None:
+            return
+        self._active_paths.discard(file_path)
+        file_path.unlink(missing_ok=True)
+        self._untrack_file(file_path)
+        file_path.with_name(file_path.name + '.aria2').unlink(missing_ok=True)
+    
+    async def _download_video(self, url, progress_callback=None, race=False, backend=None):
+        """Probe the link and run the chosen download backends"""
+        file_path = None
         try:
             # Validate URL format
             if not url or not isinstance(url, str):
@@ -355,72 +892,113 @@ class VideoDownloader:
             if progress_callback:
                 await progress_callback("🔍 Validating download link...")
             
-            filename = self.get_filename_from_url(url)
-            file_path = self.download_dir / filename
-            
-            # Remove existing file if present to start fresh
-            if file_path.exists():
-                file_path.unlink()
+            # One HEAD round trip tells us which backend can succeed
+            try:
+                probe = await self._probe(url)
+                logger.info(f"Probe: HTTP {probe[0]}, {probe[1]} bytes, ranges={probe[2] or 'none'}, type={probe[3] or 'unknown'}")
+            except Exception as e:
+                logger.warning(f"HEAD probe failed, trying every backend: {e}")
+                probe = None
             
-            # Try aria2c first (preferred for large files)
-            if aria2c_available:
-                logger.info("Attempting download with aria2c")
-                success = await self.download_with_aria2c(url, file_path, progress_callback)
-                
-                if success and file_path.exists():
-                    file_size = file_path.stat().st_size
-                    logger.info(f"Download completed with aria2c: {file_path} ({file_size / (1024*1024):.2f} MB)")
-                    if progress_callback:
-                        await progress_callback(f"✅ Download completed! ({file_size / (1024*1024):.1f} MB)")
-                    return str(file_path)
-            
-            # Fallback to wget if aria2c failed or not available
-            if wget_available:
-                logger.info("Attempting download with wget")
+            if probe and 400 <= probe[0] < 500 and probe[0] not in PROBE_INCONCLUSIVE_STATUSES:
+                logger.error(f"Download link returned HTTP {probe[0]}")
                 if progress_callback:
-                    await progress_callback("🔄 Retrying with wget...")
-                
-                success = await self.download_with_wget(url, file_path, progress_callback)
-                
-                if success and file_path.exists():
-                    file_size = file_path.stat().st_size
-                    logger.info(f"Download completed with wget: {file_path} ({file_size / (1024*1024):.2f} MB)")
-                    if progress_callback:
-                        await progress_callback(f"✅ Download completed! ({file_size / (1024*1024):.1f} MB)")
-                    return str(file_path)
-            
-            # Final fallback to Python requests
-            logger.info("Attempting download with Python requests")
-            if progress_callback:
-                await progress_callback("🔄 Trying with Python requests...")
+                    await progress_callback(f"❌ Download link returned HTTP {probe[0]}")
+                return None
             
-            success = await self.download_with_requests(url, file_path, progress_callback)
+            # Concurrent downloads of same-named files each get their own path
+            file_path = self._reserve_path(get_filename_from_url(url))
             
-            if success and file_path.exists():
-                file_size = file_path.stat().st_size
-                logger.info(f"Download completed with Python requests: {file_path} ({file_size / (1024*1024):.2f} MB)")
-                if progress_callback:
-                    await progress_callback(f"✅ Download completed! ({file_size / (1024*1024):.1f} MB)")
-                return str(file_path)
+            # Remove a stale file left by an earlier run to start fresh
+            file_path.unlink(missing_ok=True)
+            self._untrack_file(file_path)
+            
+            if backend:
+                backends = [self._get_backend(backend, probe)]
+            else:
+                backends = self._plan_backends(probe, aria2c_available, wget_available)
+            
+            if race and len(backends) > 1:
+                # Spend extra bandwidth to get the latency of the fastest backend
+                logger.info(f"Racing download backends: {', '.join(name for name, _ in backends)}")
+                name = await self._race_backends(url, file_path, backends, progress_callback)
+                if name:
+                    return await self._finish_download(name, file_path, progress_callback)
+            else:
+                for name, backend in backends:
+                    logger.info(f"Attempting download with {name}")
+                    success = await backend(url, file_path, progress_callback)
+                    
+                    if success and file_path.exists():
+                        return await self._finish_download(name, file_path, progress_callback)
             
             # If we reach here, all methods failed
+            self._discard_partial(file_path)
             logger.error("All download methods failed")
             if progress_callback:
                 await progress_callback("❌ All download methods failed!")
             return None
             
+        except asyncio.CancelledError:
+            # Timed out or cancelled mid-transfer: don't leak the partial file
+            self._discard_partial(file_path)
+            raise
         except Exception as e:
+            self._discard_partial(file_path)
             logger.error(f"Download failed for URL {url}: {e}")
             if progress_callback:
                 await progress_callback(f"❌ Download failed: {str(e)}")
             return None
     
-    def cleanup_file(self, file_path):
-        """Delete downloaded file"""
+    async def cleanup_file_async(self, file_path):
+        """Delete downloaded file without blocking the event loop"""
+        path = Path(file_path)
         try:
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"Deleted file: {file_path}")
-        except Exception as e:
+            # Unlinking a multi-GB file can stall; only the syscall goes to a thread,
+            # the bookkeeping stays on the loop
+            await asyncio.to_thread(path.unlink, missing_ok=True)
+            self._untrack_file(path)
+            logger.info(f"Deleted file: {file_path}")
+        except OSError as e:
             logger.error(f"Failed to delete file {file_path}: {e}")
-                
+        finally:
+            # Released only once the file is gone, so a new download can't reuse the name early
+            self._active_paths.discard(path)
+    
+    async def storage_usage(self):
+        """Return (total bytes, file count) of the download directory"""
+        if self._file_sizes is None:
+            # Cold start: pick up files left by an earlier run, then track incrementally.
+            # The walk runs in a thread; the counters are only set here on the loop
+            file_sizes = await asyncio.to_thread(self._scan_download_dir)
+            self._file_sizes = file_sizes
+            self._stored_bytes = sum(file_sizes.values())
+        return self._stored_bytes, len(self._file_sizes)
+    
+    def _scan_download_dir(self):
+        """Map each file in download_dir to its size"""
+        file_sizes = {}
+        try:
+            with os.scandir(self.download_dir) as entries:
+                for entry in entries:
+                    if entry.is_file(follow_symlinks=False):
+                        file_sizes[Path(entry.path)] = entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        return file_sizes
+    
+    def reset_storage_usage(self):
+        """Forget the tracked sizes so the next storage_usage() rescans"""
+        self._file_sizes = None
+        self._stored_bytes = 0
+    
+    def _track_file(self, file_path, size):
+        """Record the size of a finished download"""
+        if self._file_sizes is not None:
+            self._stored_bytes += size - self._file_sizes.get(file_path, 0)
+            self._file_sizes[file_path] = size
+    
+    def _untrack_file(self, file_path):
+        """Stop counting a deleted file"""
+        if self._file_sizes is not None:
+            self._stored_bytes -= self._file_sizes.pop(file_path, 0)
@@ -1,27 +1,27 @@
-
-from flask import Flask
-from threading import Thread
+from aiohttp import web
 import time
 
-app = Flask('')
-
-@app.route('/')
-def home():
-    return "Bot is alive!"
+async def home(request):
+    return web.Response(text="Bot is alive!")
 
-@app.route('/status')
-def status():
-    return {
+async def status(request):
+    return web.json_response({
         "status": "running",
         "timestamp": time.time(),
         "message": "Telegram Video Downloader Bot is active"
-    }
-
-def run():
-    app.run(host='0.0.0.0', port=8080)
+    })
 
-def keep_alive():
-    t = Thread(target=run)
-    t.daemon = True
-    t.start()
-  
+async def keep_alive(host='0.0.0.0', port=8080):
+    """Serve the health endpoints on the running event loop and return the runner"""
+    app = web.Application()
+    app.router.add_get('/', home)
+    app.router.add_get('/status', status)
+    
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+    return runner
@@ -1,19 +1,25 @@
 
 import os
+import re
 import asyncio
+import itertools
 import logging
+import aiohttp
 import psutil
-import time
-import shutil
-import subprocess
 from datetime import datetime, timedelta
-from collections import deque
+from pathlib import Path
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from downloader import VideoDownloader
-from userbot import TelegramUserbot
+from downloader import VideoDownloader, find_tool, format_size
+from userbot import get_userbot
 from keep_alive import keep_alive
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -21,6 +27,20 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# /status sizes read "1.50 GB", with a space before the unit
+_BYTE_UNITS = (' B', ' KB', ' MB', ' GB', ' TB', ' PB')
+
+# A whole message that is one http(s) link of at least 10 characters
+_URL_RE = re.compile(r'(?=\S{10})https?://\S*')
+
+# Progress edits from every worker are flushed by one task at this interval,
+# keeping the bot well under Telegram's per-bot message rate
+EDIT_FLUSH_INTERVAL = 0.7
+
+def format_bytes(bytes_val):
+    """Format bytes to human readable format"""
+    return format_size(bytes_val, precision=2, units=_BYTE_UNITS)
+
 class QueueItem:
     def __init__(self, url, chat_id, message_id, user_id):
         self.url = url
@@ -34,11 +54,36 @@ class TelegramBot:
     def __init__(self):
         self.bot_token = os.getenv('BOT_TOKEN')
         self.downloader = VideoDownloader()
-        self.userbot = TelegramUserbot()
-        self.download_queue = deque()
-        self.is_processing = False
-        self.current_item = None
-        self.cancelled = False
+        self.userbot = None  # Shared userbot, connected in post_init()
+        # Bounded so a flood of links can't grow memory without limit
+        self.max_queue_size = int(os.getenv('MAX_QUEUE_SIZE', '200'))
+        self.max_per_user = int(os.getenv('MAX_ITEMS_PER_USER', '20'))
+        self.download_queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._per_user_count = {}
+        self._workers = []
+        self.active_items = []
+        
+        # Downloads are I/O-bound, so several can run at once; uploads go
+        # through one userbot session and stay serialized
+        self.max_concurrent = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '3'))
+        self._upload_sem = asyncio.Semaphore(1)
+        
+        # CPU usage is sampled in the background so /status never blocks
+        self._process = psutil.Process(os.getpid())
+        self._cpu_percent = 0.0
+        self._process_cpu_percent = 0.0
+        self._cpu_sampler_task = None
+        self._keep_alive_runner = None
+        
+        # Newest pending text per progress message, sent by _edit_flusher()
+        self._pending_edits = {}
+        self._edit_flusher_task = None
+        
+        # Figures that never change while the bot runs
+        self._boot_time = datetime.fromtimestamp(psutil.boot_time())
+        self._cpu_count = psutil.cpu_count()
+        cpu_freq = psutil.cpu_freq()  # None where the kernel exposes no cpufreq
+        self._cpu_freq_max = cpu_freq.max if cpu_freq else 0.0
         
         if not self.bot_token:
             raise ValueError("BOT_TOKEN not found in environment variables")
@@ -50,7 +95,7 @@ class TelegramBot:
             "Send me direct download links and I'll queue them for processing!\n\n"
             "Features:\n"
             "• Queue multiple downloads\n"
-            "• Process files one by one\n"
+            "• Process several files at once\n"
             "• Real-time progress updates\n"
             "• Cancel all downloads\n"
             "• Storage management\n\n"
@@ -68,7 +113,7 @@ class TelegramBot:
             "📋 How to use the Queue System:\n\n"
             "1. Send me direct download links\n"
             "2. Each link will be added to the queue\n"
-            "3. Bot processes files one by one\n"
+            "3. Bot processes several files at once\n"
             "4. Get progress updates for each file\n"
             "5. Files are sent to target group automatically\n\n"
             "Commands:\n"
@@ -82,54 +127,57 @@ class TelegramBot:
     
     async def queue_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /queue command - show current queue"""
-        if not self.download_queue and not self.current_item:
+        queued_count = self.download_queue.qsize()
+        if not queued_count and not self.active_items:
             await update.message.reply_text("📭 Queue is empty!")
             return
         
-        queue_text = "📋 **Download Queue Status**\n━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
+        # Collect lines and join once instead of growing a string with +=
+        lines = ["📋 **Download Queue Status**", "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━", ""]
         
-        # Show current processing item
-        if self.current_item:
-            queue_text += f"🔄 **Currently Processing:**\n"
-            queue_text += f"├─ Status: {self.current_item.status.title()}\n"
-            queue_text += f"├─ URL: {self.current_item.url[:50]}...\n"
-            queue_text += f"└─ User: {self.current_item.user_id}\n\n"
+        # Show items being processed
+        if self.active_items:
+            lines.append(f"🔄 **Currently Processing ({len(self.active_items)}):**")
+            for item in self.active_items:
+                lines.append(f"├─ Status: {item.status.title()}")
+                lines.append(f"├─ URL: {item.url[:50]}...")
+                lines.append(f"└─ User: {item.user_id}")
+                lines.append("")
         
         # Show queued items
-        if self.download_queue:
-            queue_text += f"⏳ **Queued Items ({len(self.download_queue)}):**\n"
-            for i, item in enumerate(list(self.download_queue)[:10], 1):  # Show first 10 items
-                queue_text += f"{i}. {item.url[:40]}... (User: {item.user_id})\n"
+        if queued_count:
+            lines.append(f"⏳ **Queued Items ({queued_count}):**")
+            # Show first 10 items without copying the whole queue
+            for i, item in enumerate(itertools.islice(self.download_queue._queue, 10), 1):
+                lines.append(f"{i}. {item.url[:40]}... (User: {item.user_id})")
             
-            if len(self.download_queue) > 10:
-                queue_text += f"...and {len(self.download_queue) - 10} more items\n"
+            if queued_count > 10:
+                lines.append(f"...and {queued_count - 10} more items")
+            lines.append("")
         
-        queue_text += f"\n🎯 **Queue Statistics:**\n"
-        queue_text += f"├─ Total in queue: {len(self.download_queue)}\n"
-        queue_text += f"├─ Processing: {'Yes' if self.is_processing else 'No'}\n"
-        queue_text += f"└─ Cancelled: {'Yes' if self.cancelled else 'No'}"
+        lines.append("🎯 **Queue Statistics:**")
+        lines.append(f"├─ Total in queue: {queued_count}")
+        lines.append(f"├─ Processing: {'Yes' if self.active_items else 'No'}")
+        lines.append(f"└─ Active workers: {len(self.active_items)}/{self.max_concurrent}")
         
-        await update.message.reply_text(queue_text)
+        await update.message.reply_text("\n".join(lines))
     
     async def cancel_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /cancel command - cancel all downloads"""
-        if not self.download_queue and not self.current_item:
+        if self.download_queue.empty() and not self.active_items:
             await update.message.reply_text("📭 No downloads to cancel!")
             return
         
-        cancelled_count = len(self.download_queue)
-        if self.current_item:
-            cancelled_count += 1
-        
-        # Set cancellation flag
-        self.cancelled = True
+        cancelled_count = self.download_queue.qsize() + len(self.active_items)
         
         # Clear the queue
-        self.download_queue.clear()
+        while not self.download_queue.empty():
+            self._release_user_slot(self.download_queue.get_nowait())
+            self.download_queue.task_done()
         
-        # Update current item status
-        if self.current_item:
-            self.current_item.status = "cancelled"
+        # Mark in-flight items so their workers stop after the current operation
+        for item in self.active_items:
+            item.status = "cancelled"
         
         await update.message.reply_text(
             f"🚫 **Download Cancellation**\n\n"
@@ -143,42 +191,36 @@ class TelegramBot:
         """Handle /del_storage command - delete all downloaded files"""
         try:
             downloads_dir = "downloads"
-            if not os.path.exists(downloads_dir):
-                await update.message.reply_text("📁 Downloads folder doesn't exist!")
-                return
             
-            # Get storage info before deletion
+            # Get storage info before deletion; scandir entries carry the
+            # file type, so each file costs one stat() instead of three
             total_size = 0
-            file_count = 0
+            files = []
             
-            for filename in os.listdir(downloads_dir):
-                filepath = os.path.join(downloads_dir, filename)
-                if os.path.isfile(filepath):
-                    total_size += os.path.getsize(filepath)
-                    file_count += 1
+            try:
+                with os.scandir(downloads_dir) as entries:
+                    for entry in entries:
+                        if entry.is_file(follow_symlinks=False):
+                            total_size += entry.stat().st_size
+                            files.append(entry.path)
+            except FileNotFoundError:
+                await update.message.reply_text("📁 Downloads folder doesn't exist!")
+                return
             
-            if file_count == 0:
+            if not files:
                 await update.message.reply_text("📁 Downloads folder is already empty!")
                 return
             
             # Delete all files
             deleted_count = 0
-            for filename in os.listdir(downloads_dir):
-                filepath = os.path.join(downloads_dir, filename)
-                if os.path.isfile(filepath):
-                    try:
-                        os.remove(filepath)
-                        deleted_count += 1
-                    except Exception as e:
-                        logger.error(f"Error deleting {filepath}: {e}")
-            
-            # Format size
-            def format_bytes(bytes_val):
-                for unit in ['B', 'KB', 'MB', 'GB']:
-                    if bytes_val < 1024.0:
-                        return f"{bytes_val:.2f} {unit}"
-                    bytes_val /= 1024.0
-                return f"{bytes_val:.2f} TB"
+            for filepath in files:
+                try:
+                    # A worker may have cleaned the file up since the scan
+                    Path(filepath).unlink(missing_ok=True)
+                    deleted_count += 1
+                except Exception as e:
+                    logger.error(f"Error deleting {filepath}: {e}")
+            self.downloader.reset_storage_usage()
             
             await update.message.reply_text(
                 f"🗑️ **Storage Cleanup Complete**\n\n"
@@ -204,52 +246,58 @@ class TelegramBot:
             logger.error(f"Error getting system status: {e}")
             await status_msg.edit_text(f"❌ Error getting system status: {str(e)}")
     
+    def _collect_sync_stats(self):
+        """Read the blocking psutil and filesystem figures for /status"""
+        process = self._process
+        
+        return {
+            'cpu_freq': psutil.cpu_freq(),
+            'memory': psutil.virtual_memory(),
+            'swap': psutil.swap_memory(),
+            'disk_usage': psutil.disk_usage('/'),
+            'net_io': psutil.net_io_counters(),
+            'process_memory': process.memory_info(),
+            'num_threads': process.num_threads(),
+            'open_files': len(process.open_files()),
+            'connections': len(process.connections()),
+            'aria2c': find_tool('aria2c'),
+            'wget': find_tool('wget'),
+        }
+    
     async def get_system_status(self):
         """Get comprehensive system status"""
         try:
+            # The psutil/filesystem reads run in a worker thread while the
+            # network checks run on the loop, so downloads keep flowing
+            stats, ping_result, speed_test = await asyncio.gather(
+                asyncio.to_thread(self._collect_sync_stats),
+                self.get_ping(),
+                self.get_network_speed()
+            )
+            
             # Basic system info
-            boot_time = datetime.fromtimestamp(psutil.boot_time())
+            boot_time = self._boot_time
             uptime = datetime.now() - boot_time
             
             # CPU information
-            cpu_percent = psutil.cpu_percent(interval=1)
-            cpu_count = psutil.cpu_count()
-            cpu_freq = psutil.cpu_freq()
+            cpu_percent = self._cpu_percent
+            cpu_count = self._cpu_count
+            cpu_freq_current = stats['cpu_freq'].current if stats['cpu_freq'] else 0.0
             
             # Memory information
-            memory = psutil.virtual_memory()
-            swap = psutil.swap_memory()
+            memory = stats['memory']
+            swap = stats['swap']
             
             # Disk information
-            disk_usage = psutil.disk_usage('/')
-            downloads_usage = 0
-            downloads_count = 0
-            if os.path.exists('downloads'):
-                for f in os.listdir('downloads'):
-                    filepath = os.path.join('downloads', f)
-                    if os.path.isfile(filepath):
-                        downloads_usage += os.path.getsize(filepath)
-                        downloads_count += 1
+            disk_usage = stats['disk_usage']
+            downloads_usage, downloads_count = await self.downloader.storage_usage()
             
             # Network information
-            net_io = psutil.net_io_counters()
+            net_io = stats['net_io']
             
             # Process information
-            process = psutil.Process(os.getpid())
-            process_memory = process.memory_info()
-            process_cpu = process.cpu_percent()
-            
-            # Get network speed test
-            ping_result = await self.get_ping()
-            speed_test = await self.get_network_speed()
-            
-            # Format sizes
-            def format_bytes(bytes_val):
-                for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-                    if bytes_val < 1024.0:
-                        return f"{bytes_val:.2f} {unit}"
-                    bytes_val /= 1024.0
-                return f"{bytes_val:.2f} PB"
+            process_memory = stats['process_memory']
+            process_cpu = self._process_cpu_percent
             
             def format_uptime(td):
                 days, seconds = td.days, td.seconds
@@ -266,7 +314,7 @@ class TelegramBot:
 🧠 **CPU Usage**
 ├─ Current: {cpu_percent}%
 ├─ Cores: {cpu_count}
-├─ Frequency: {cpu_freq.current:.2f} MHz (max: {cpu_freq.max:.2f} MHz)
+├─ Frequency: {cpu_freq_current:.2f} MHz (max: {self._cpu_freq_max:.2f} MHz)
 └─ Bot Process: {process_cpu}%
 
 💾 **Memory Usage**
@@ -281,7 +329,7 @@ class TelegramBot:
 ├─ Used: {format_bytes(disk_usage.used)} ({disk_usage.percent}%)
 ├─ Free: {format_bytes(disk_usage.free)}
 ├─ Downloads: {format_bytes(downloads_usage)} ({downloads_count} files)
-└─ Queue: {len(self.download_queue)} items
+└─ Queue: {self.download_queue.qsize()} items
 
 🌐 **Network Statistics**
 ├─ Bytes Sent: {format_bytes(net_io.bytes_sent)}
@@ -294,23 +342,22 @@ class TelegramBot:
 {speed_test}
 
 🔧 **Tools Status**
-├─ aria2c: {'✅ Available' if shutil.which('aria2c') else '❌ Not found'}
-├─ wget: {'✅ Available' if shutil.which('wget') else '❌ Not found'}
+├─ aria2c: {'✅ Available' if stats['aria2c'] else '❌ Not found'}
+├─ wget: {'✅ Available' if stats['wget'] else '❌ Not found'}
 └─ Python: {psutil.version_info}
 
 📊 **Bot Status**
 ├─ PID: {os.getpid()}
-├─ Threads: {process.num_threads()}
-├─ Open Files: {len(process.open_files())}
-├─ Connections: {len(process.connections())}
-├─ Queue Processing: {'✅ Active' if self.is_processing else '⏸️ Idle'}
-└─ Current Item: {'✅ Yes' if self.current_item else '❌ None'}
+├─ Threads: {stats['num_threads']}
+├─ Open Files: {stats['open_files']}
+├─ Connections: {stats['connections']}
+├─ Queue Processing: {'✅ Active' if self.active_items else '⏸️ Idle'}
+└─ Current Items: {len(self.active_items)}/{self.max_concurrent}
 
 📋 **Queue Status**
-├─ Items in Queue: {len(self.download_queue)}
-├─ Currently Processing: {'✅ Yes' if self.current_item else '❌ No'}
-├─ Cancelled: {'✅ Yes' if self.cancelled else '❌ No'}
-└─ Processing Status: {'🔄 Running' if self.is_processing else '⏸️ Idle'}
+├─ Items in Queue: {self.download_queue.qsize()}
+├─ Currently Processing: {'✅ Yes' if self.active_items else '❌ No'}
+└─ Processing Status: {'🔄 Running' if self.active_items else '⏸️ Idle'}
 ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
 🕐 Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"""
             
@@ -320,32 +367,20 @@ class TelegramBot:
             logger.error(f"Error in get_system_status: {e}")
             return f"❌ Error getting system status: {str(e)}"
     
-    async def get_ping(self):
+    async def get_ping(self, host='8.8.8.8', port=53, attempts=3):
         """Get ping to Google DNS"""
+        # Time TCP handshakes instead of spawning ping and parsing its
+        # (locale-dependent) output
+        loop = asyncio.get_running_loop()
+        samples = []
         try:
-            result = await asyncio.wait_for(
-                asyncio.create_subprocess_exec(
-                    'ping', '-c', '3', '8.8.8.8',
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                ),
-                timeout=10
-            )
-            stdout, stderr = await result.communicate()
-            
-            if result.returncode == 0:
-                output = stdout.decode()
-                # Extract average ping time
-                for line in output.split('\n'):
-                    if 'avg' in line or 'min/avg/max' in line:
-                        try:
-                            avg_time = line.split('/')[-2]
-                            return f"{avg_time}ms"
-                        except:
-                            pass
-                return "Connected"
-            else:
-                return "❌ Failed"
+            for _ in range(attempts):
+                start_time = loop.time()
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=2)
+                samples.append((loop.time() - start_time) * 1000)
+                writer.close()
+                await writer.wait_closed()
+            return f"{sum(samples) / len(samples):.1f}ms"
         except asyncio.TimeoutError:
             return "⏱️ Timeout"
         except Exception as e:
@@ -354,53 +389,44 @@ class TelegramBot:
     async def get_network_speed(self):
         """Get network speed test"""
         try:
-            # Simple speed test using curl to download a small file
-            start_time = time.time()
+            # Time transfers over the downloader's pooled session instead of
+            # spawning curl for each direction
+            session = await self.downloader.get_session()
+            loop = asyncio.get_running_loop()
             
             # Test download speed
-            result = await asyncio.wait_for(
-                asyncio.create_subprocess_exec(
-                    'curl', '-s', '-o', '/dev/null', '-w', '%{speed_download}',
-                    'https://httpbin.org/bytes/1048576',  # 1MB file
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                ),
-                timeout=15
-            )
-            
-            stdout, stderr = await result.communicate()
+            received = 0
+            start_time = loop.time()
+            async with session.get(
+                'https://httpbin.org/bytes/1048576',  # 1MB file
+                timeout=aiohttp.ClientTimeout(total=15)
+            ) as response:
+                response.raise_for_status()
+                async for data in response.content.iter_any():
+                    received += len(data)
+            download_speed_mb = received / (loop.time() - start_time) / (1024 * 1024)
             
-            if result.returncode == 0:
-                download_speed = float(stdout.decode().strip())
-                download_speed_mb = download_speed / (1024 * 1024)
+            # Test upload speed (simplified)
+            try:
+                payload = b'x' * 10240  # 10KB test
+                upload_start = loop.time()
+                async with session.post(
+                    'https://httpbin.org/post',
+                    data=payload,
+                    timeout=aiohttp.ClientTimeout(total=10)
+                ) as response:
+                    response.raise_for_status()
+                    await response.read()
+                upload_speed_mb = len(payload) / (loop.time() - upload_start) / (1024 * 1024)
                 
-                # Test upload speed (simplified)
-                upload_start = time.time()
-                upload_result = await asyncio.wait_for(
-                    asyncio.create_subprocess_exec(
-                        'curl', '-s', '-o', '/dev/null', '-w', '%{speed_upload}',
-                        '-X', 'POST', '--data', 'x' * 10240,  # 10KB test
-                        'https://httpbin.org/post',
-                        stdout=asyncio.subprocess.PIPE,
-                        stderr=asyncio.subprocess.PIPE
-                    ),
-                    timeout=10
-                )
-                
-                upload_stdout, upload_stderr = await upload_result.communicate()
-                
-                if upload_result.returncode == 0:
-                    upload_speed = float(upload_stdout.decode().strip())
-                    upload_speed_mb = upload_speed / (1024 * 1024)
-                    
-                    return f"├─ Download: {download_speed_mb:.2f} MB/s\n└─ Upload: {upload_speed_mb:.2f} MB/s"
-                else:
-                    return f"├─ Download: {download_speed_mb:.2f} MB/s\n└─ Upload: ❌ Failed"
-            else:
-                return "❌ Speed test failed"
+                return f"├─ Download: {download_speed_mb:.2f} MB/s\n└─ Upload: {upload_speed_mb:.2f} MB/s"
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                return f"├─ Download: {download_speed_mb:.2f} MB/s\n└─ Upload: ❌ Failed"
                 
         except asyncio.TimeoutError:
             return "⏱️ Speed test timeout"
+        except aiohttp.ClientError:
+            return "❌ Speed test failed"
         except Exception as e:
             return f"❌ Speed test error: {str(e)[:30]}"
     
@@ -409,7 +435,7 @@ class TelegramBot:
         message_text = update.message.text.strip()
         
         # Check if message contains a URL
-        if not (message_text.startswith('http://') or message_text.startswith('https://')):
+        if not message_text.startswith(('http://', 'https://')):
             await update.message.reply_text(
                 "❌ Please send a valid direct download link!\n\n"
                 "Example: https://example.com/video.mp4\n"
@@ -418,7 +444,7 @@ class TelegramBot:
             return
         
         # Basic URL validation
-        if len(message_text) < 10 or ' ' in message_text:
+        if not _URL_RE.fullmatch(message_text):
             await update.message.reply_text("❌ Invalid URL format. Please send a proper direct download link!")
             return
         
@@ -431,10 +457,22 @@ class TelegramBot:
         )
         
         # Add to queue
-        self.download_queue.append(queue_item)
+        user_id = queue_item.user_id
+        if self._per_user_count.get(user_id, 0) >= self.max_per_user:
+            await update.message.reply_text(
+                f"⚠️ You already have {self.max_per_user} links in the queue.\n"
+                f"Please wait for some of them to finish."
+            )
+            return
+        try:
+            self.download_queue.put_nowait(queue_item)
+        except asyncio.QueueFull:
+            await update.message.reply_text("⚠️ Queue is full, please try again later.")
+            return
+        self._per_user_count[user_id] = self._per_user_count.get(user_id, 0) + 1
         
         # Send confirmation
-        position = len(self.download_queue)
+        position = self.download_queue.qsize()
         confirm_msg = await update.message.reply_text(
             f"✅ **Link Added to Queue!**\n\n"
             f"🔗 URL: {message_text[:50]}...\n"
@@ -443,144 +481,206 @@ class TelegramBot:
             f"📋 Use /queue to see full queue\n"
             f"🚫 Use /cancel to cancel all downloads"
         )
-        
-        # Start processing if not already running
-        if not self.is_processing:
-            asyncio.create_task(self.process_queue())
     
-    async def process_queue(self):
-        """Process the download queue"""
-        if self.is_processing:
+    def _release_user_slot(self, item):
+        """Drop an item from its user's count of queued and active links"""
+        count = self._per_user_count.get(item.user_id, 0) - 1
+        if count > 0:
+            self._per_user_count[item.user_id] = count
+        else:
+            self._per_user_count.pop(item.user_id, None)
+    
+    async def _worker(self):
+        """Take items off the queue for the lifetime of the bot"""
+        while True:
+            item = await self.download_queue.get()
+            self.active_items.append(item)
+            try:
+                await self.process_item(item)
+            except Exception as e:
+                logger.error(f"Error processing {item.url}: {e}")
+                item.status = "failed"
+            finally:
+                self.active_items.remove(item)
+                self._release_user_slot(item)
+                self.download_queue.task_done()
+            
+            # Small delay between items
+            await asyncio.sleep(2)
+    
+    async def process_item(self, item):
+        """Download one queue item and send it to the target group"""
+        logger.info(f"Processing item: {item.url}")
+        
+        # Send processing message
+        try:
+            item.progress_message = await self.application.bot.send_message(
+                chat_id=item.chat_id,
+                text=f"🔄 **Processing Your Download**\n\n"
+                     f"🔗 URL: {item.url[:50]}...\n"
+                     f"📍 Status: Starting download...\n"
+                     f"⏳ Please wait..."
+            )
+        except Exception as e:
+            logger.error(f"Error sending progress message: {e}")
+            return
+        
+        # Check if cancelled
+        if item.status == "cancelled":
+            self._queue_edit(item.progress_message, "🚫 Download cancelled!")
             return
         
-        self.is_processing = True
-        logger.info("Starting queue processing...")
+        # Update status
+        item.status = "downloading"
         
-        try:
-            while self.download_queue and not self.cancelled:
-                # Get next item
-                self.current_item = self.download_queue.popleft()
-                
-                logger.info(f"Processing item: {self.current_item.url}")
-                
-                # Send processing message
-                try:
-                    self.current_item.progress_message = await self.application.bot.send_message(
-                        chat_id=self.current_item.chat_id,
-                        text=f"🔄 **Processing Your Download**\n\n"
-                             f"🔗 URL: {self.current_item.url[:50]}...\n"
-                             f"📍 Status: Starting download...\n"
-                             f"⏳ Please wait..."
-                    )
-                except Exception as e:
-                    logger.error(f"Error sending progress message: {e}")
-                    continue
-                
-                # Check if cancelled
-                if self.cancelled:
-                    try:
-                        await self.current_item.progress_message.edit_text("🚫 Download cancelled!")
-                    except:
-                        pass
-                    break
-                
-                # Update status
-                self.current_item.status = "downloading"
-                
-                # Create progress callback
-                async def progress_callback(message):
-                    if self.current_item.progress_message and not self.cancelled:
-                        try:
-                            await self.current_item.progress_message.edit_text(
-                                f"📥 **Downloading**\n\n"
-                                f"🔗 URL: {self.current_item.url[:50]}...\n"
-                                f"📊 {message}"
-                            )
-                        except:
-                            pass
-                
-                # Download the file
-                file_path = await self.downloader.download_video(
-                    self.current_item.url, 
-                    progress_callback=progress_callback
+        # Create progress callback
+        async def progress_callback(message):
+            if item.progress_message and item.status != "cancelled":
+                self._queue_edit(
+                    item.progress_message,
+                    f"📥 **Downloading**\n\n"
+                    f"🔗 URL: {item.url[:50]}...\n"
+                    f"📊 {message}"
                 )
-                
-                if not file_path or self.cancelled:
-                    try:
-                        await self.current_item.progress_message.edit_text(
-                            f"❌ **Download Failed**\n\n"
-                            f"🔗 URL: {self.current_item.url[:50]}...\n"
-                            f"💔 Could not download the file"
-                        )
-                    except:
-                        pass
-                    self.current_item.status = "failed"
-                    self.current_item = None
-                    continue
-                
-                # Update status to uploading
-                self.current_item.status = "uploading"
-                
-                # Create upload progress callback
-                async def upload_progress_callback(message):
-                    if self.current_item.progress_message and not self.cancelled:
-                        try:
-                            await self.current_item.progress_message.edit_text(
-                                f"📤 **Uploading to Telegram**\n\n"
-                                f"🔗 URL: {self.current_item.url[:50]}...\n"
-                                f"📊 {message}"
-                            )
-                        except:
-                            pass
-                
-                # Send via userbot
-                success = await self.userbot.send_video_to_group(
-                    file_path, 
-                    progress_callback=upload_progress_callback
+        
+        # Download the file
+        file_path = await self.downloader.download_video(
+            item.url, 
+            progress_callback=progress_callback
+        )
+        
+        if not file_path or item.status == "cancelled":
+            if file_path:
+                self.downloader.release_path(file_path)
+            self._queue_edit(
+                item.progress_message,
+                f"❌ **Download Failed**\n\n"
+                f"🔗 URL: {item.url[:50]}...\n"
+                f"💔 Could not download the file"
+            )
+            item.status = "failed"
+            return
+        
+        # Create upload progress callback
+        async def upload_progress_callback(message):
+            if item.progress_message and item.status != "cancelled":
+                self._queue_edit(
+                    item.progress_message,
+                    f"📤 **Uploading to Telegram**\n\n"
+                    f"🔗 URL: {item.url[:50]}...\n"
+                    f"📊 {message}"
                 )
-                
-                if success and not self.cancelled:
-                    try:
-                        await self.current_item.progress_message.edit_text(
-                            f"✅ **Upload Completed!**\n\n"
-                            f"🔗 URL: {self.current_item.url[:50]}...\n"
-                            f"📱 Video sent to target group successfully!\n"
-                            f"🗑️ File cleaned up from storage"
-                        )
-                    except:
-                        pass
-                    self.current_item.status = "completed"
-                elif not self.cancelled:
-                    try:
-                        await self.current_item.progress_message.edit_text(
-                            f"❌ **Upload Failed**\n\n"
-                            f"🔗 URL: {self.current_item.url[:50]}...\n"
-                            f"💔 Could not send to target group"
-                        )
-                    except:
-                        pass
-                    self.current_item.status = "failed"
-                
-                # Clean up current item
-                self.current_item = None
-                
-                # Small delay between items
-                await asyncio.sleep(2)
-            
-            # Reset cancellation flag
-            self.cancelled = False
+        
+        # Send via userbot, one upload at a time
+        async with self._upload_sem:
+            if item.status == "cancelled":
+                self.downloader.release_path(file_path)
+                return
+            item.status = "uploading"
+            success = await self.userbot.send_video_to_group(
+                file_path, 
+                progress_callback=upload_progress_callback
+            )
+        
+        if success and item.status != "cancelled":
+            self._queue_edit(
+                item.progress_message,
+                f"✅ **Upload Completed!**\n\n"
+                f"🔗 URL: {item.url[:50]}...\n"
+                f"📱 Video sent to target group successfully!\n"
+                f"🗑️ File cleaned up from storage"
+            )
+            item.status = "completed"
+        elif item.status != "cancelled":
+            self._queue_edit(
+                item.progress_message,
+                f"❌ **Upload Failed**\n\n"
+                f"🔗 URL: {item.url[:50]}...\n"
+                f"💔 Could not send to target group"
+            )
+            item.status = "failed"
+    
+    def _queue_edit(self, message, text):
+        """Schedule a message edit; only the newest text per message is sent"""
+        self._pending_edits[(message.chat_id, message.message_id)] = (message, text)
+    
+    async def _edit_flusher(self):
+        """Send pending message edits, at most one per message per interval"""
+        while True:
+            await asyncio.sleep(EDIT_FLUSH_INTERVAL)
+            pending = list(self._pending_edits.items())
+            self._pending_edits.clear()
             
-        except Exception as e:
-            logger.error(f"Error in process_queue: {e}")
-        finally:
-            self.is_processing = False
-            self.current_item = None
-            logger.info("Queue processing finished")
+            for index, (key, (message, text)) in enumerate(pending):
+                try:
+                    await message.edit_text(text)
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    logger.warning(f"Telegram flood control, pausing message edits for {delay}s")
+                    # Put back the unsent edits unless newer text arrived meanwhile
+                    for key, edit in pending[index:]:
+                        self._pending_edits.setdefault(key, edit)
+                    await asyncio.sleep(delay)
+                    break
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        logger.debug(f"Could not edit message: {e}")
+                except Exception as e:
+                    logger.debug(f"Could not edit message: {e}")
+    
+    async def _cpu_sampler(self):
+        """Refresh the CPU usage figures once per second"""
+        while True:
+            # interval=None returns usage since the previous call without sleeping
+            self._cpu_percent = psutil.cpu_percent(interval=None)
+            self._process_cpu_percent = self._process.cpu_percent(interval=None)
+            await asyncio.sleep(1)
+    
+    async def post_init(self, application):
+        """Start the background services once the event loop is running"""
+        # Health endpoints share the bot's event loop instead of a server thread
+        try:
+            self._keep_alive_runner = await keep_alive()
+            logger.info("Keep-alive server started on port 8080")
+        except OSError as e:
+            # The bot works without health checks, e.g. when the port is taken
+            logger.error(f"Keep-alive server failed to start: {e}")
+        
+        # Connect before the workers start so the first upload doesn't pay for it
+        self.userbot = await get_userbot(self.downloader)
+        
+        self._cpu_sampler_task = asyncio.create_task(self._cpu_sampler())
+        self._edit_flusher_task = asyncio.create_task(self._edit_flusher())
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrent)]
+        logger.info(f"Started {self.max_concurrent} queue workers")
+    
+    async def post_shutdown(self, application):
+        """Stop background tasks and release shared network resources"""
+        tasks = [
+            task for task in (*self._workers, self._cpu_sampler_task, self._edit_flusher_task)
+            if task
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._keep_alive_runner:
+            await self._keep_alive_runner.cleanup()
+        if self.userbot:
+            await self.userbot.disconnect(shutdown=True)
+        await self.downloader.close()
     
     def run(self):
         """Start the bot"""
         try:
-            self.application = Application.builder().token(self.bot_token).build()
+            self.application = (
+                Application.builder()
+                .token(self.bot_token)
+                .post_init(self.post_init)
+                .post_shutdown(self.post_shutdown)
+                .build()
+            )
             
             # Add handlers
             self.application.add_handler(CommandHandler("start", self.start_command))
@@ -604,9 +704,10 @@ class TelegramBot:
 
 if __name__ == "__main__":
     try:
-        # Start the keep_alive web server
-        keep_alive()
-        logger.info("Keep-alive server started on port 8080")
+        # libuv-based loop: cheaper socket reads and subprocess I/O when available
+        if uvloop:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logger.info("Using uvloop event loop")
         
         # Start the main bot
         bot = TelegramBot()
@@ -1,22 +1,147 @@
 import os
+import json
+import time
+import random
+import hashlib
 import asyncio
+import struct
 import logging
+import functools
+import subprocess
+import aiofiles
 from telethon import TelegramClient
 from telethon.sessions import StringSession
-from telethon.errors import SessionPasswordNeededError
-from telethon.tl.types import DocumentAttributeVideo
+from telethon.errors import FloodWaitError, SessionPasswordNeededError
+from telethon.helpers import generate_random_long
+from telethon.network import MTProtoSender
+from telethon.tl.functions.upload import SaveBigFilePartRequest, SaveFilePartRequest
+from telethon.tl.types import DocumentAttributeVideo, InputFile, InputFileBig
 from pathlib import Path
-from downloader import VideoDownloader
+from downloader import VideoDownloader, find_tool, format_size
 
 logger = logging.getLogger(__name__)
 
+# Files over 10 MB are uploaded as "big" files, whose parts may arrive in any
+# order; those are sent over several connections at once (more than 4 tends
+# to trigger flood waits)
+BIG_FILE_SIZE = 10 * 1024 * 1024
+UPLOAD_PART_SIZE = 512 * 1024  # Largest part size Telegram accepts
+UPLOAD_WORKERS = max(1, min(4, int(os.getenv('UPLOAD_WORKERS', '4'))))
+
+# Longest FloodWait an upload sleeps through; longer ones fail the upload so
+# the queued uploads behind it aren't stuck waiting with no feedback
+MAX_FLOOD_WAIT = 300
+
+CAPTION_TMPL = "📹 {name}\n💾 Size: {mb:.2f} MB"
+
+# Connected clients shared by every TelegramUserbot in the process, keyed by
+# (api_id, session string), so a login is only negotiated once
+_CLIENT_CACHE = {}
+
+# Used when neither the mp4 header nor ffprobe give the frame size
+DEFAULT_VIDEO_WIDTH = 1280
+DEFAULT_VIDEO_HEIGHT = 720
+
+# A moov box this big means a very long or unusual file; leave it to ffprobe
+MP4_MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+def _iter_mp4_boxes(data, start=0, end=None):
+    """Yield (type, body_start, box_end) for the mp4 boxes in data[start:end]"""
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, start)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, start + 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - start
+        if size < header_size or start + size > end:
+            return
+        yield box_type, start + header_size, start + size
+        start += size
+
+def _parse_mp4_moov(moov):
+    """Read (duration, width, height) from the body of an mp4 moov box"""
+    duration, width, height = 0, None, None
+    for box_type, body, box_end in _iter_mp4_boxes(moov):
+        if box_type == b'mvhd':
+            if moov[body] == 1:
+                timescale, length = struct.unpack_from('>IQ', moov, body + 20)
+            else:
+                timescale, length = struct.unpack_from('>II', moov, body + 12)
+            if timescale:
+                duration = round(length / timescale)
+        elif box_type == b'trak' and width is None:
+            size = None
+            is_video = False
+            for child, child_body, child_end in _iter_mp4_boxes(moov, body, box_end):
+                if child == b'tkhd':
+                    # Width and height are 16.16 fixed point after the matrix
+                    dims_offset = 88 if moov[child_body] == 1 else 76
+                    size = struct.unpack_from('>II', moov, child_body + dims_offset)
+                elif child == b'mdia':
+                    for grandchild, grandchild_body, _ in _iter_mp4_boxes(moov, child_body, child_end):
+                        if grandchild == b'hdlr':
+                            is_video = moov[grandchild_body + 8:grandchild_body + 12] == b'vide'
+            if is_video and size:
+                width, height = size[0] >> 16 or None, size[1] >> 16 or None
+    return duration, width, height
+
+async def _probe_mp4(af, file_size):
+    """Read (duration, width, height) from an mp4's moov box, or None if the file isn't mp4"""
+    offset = 0
+    # Only the top-level box headers are read until moov turns up, wherever it is
+    while offset + 8 <= file_size:
+        await af.seek(offset)
+        header = await af.read(16)
+        if len(header) < 8:
+            return None
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1 and len(header) == 16:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header_size or (offset == 0 and box_type != b'ftyp'):
+            return None
+        if box_type == b'moov':
+            if size > MP4_MAX_MOOV_SIZE:
+                return None
+            await af.seek(offset + header_size)
+            return _parse_mp4_moov(await af.read(size - header_size))
+        offset += size
+    return None
+
+@functools.lru_cache(maxsize=64)
+def _ffprobe_video(file_path, mtime_ns):
+    """Read (duration, width, height) with ffprobe; mtime_ns ties the cache to one file version"""
+    result = subprocess.run(
+        [
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'format=duration:stream=width,height',
+            '-of', 'json',
+            file_path
+        ],
+        capture_output=True,
+        timeout=30,
+        check=True
+    )
+    info = json.loads(result.stdout)
+    stream = (info.get('streams') or [{}])[0]
+    duration = float(info.get('format', {}).get('duration') or 0)
+    return round(duration), stream.get('width'), stream.get('height')
+
 class TelegramUserbot:
-    def __init__(self):
+    def __init__(self, downloader=None):
         self.api_id = os.getenv('API_ID')
         self.api_hash = os.getenv('API_HASH')
         self.session_string = os.getenv('SESSION_STRING')
         self.group_id = os.getenv('GROUP_ID')
-        self.downloader = VideoDownloader()
+        if downloader is not None:
+            self.downloader = downloader
 
         # Validate required environment variables
         if not all([self.api_id, self.api_hash, self.group_id]):
@@ -29,10 +154,28 @@ class TelegramUserbot:
             raise ValueError("API_ID and GROUP_ID must be integers")
 
         self.client = None
+        # Idle connections used for file parts, kept between uploads
+        self._upload_senders = []
+        self._upload_queue = asyncio.Queue()
+        self._upload_worker_task = None
+
+    @functools.cached_property
+    def downloader(self):
+        """Downloader used for file cleanup, built on first use when none was passed in"""
+        return VideoDownloader()
 
     async def initialize_client(self):
-        """Initialize Telegram client"""
+        """Initialize Telegram client, reusing a cached one for the same session"""
+        cache_key = (self.api_id, self.session_string or '')
         try:
+            client = _CLIENT_CACHE.get(cache_key)
+            if client is not None:
+                if not client.is_connected():
+                    logger.info("Reconnecting cached Telegram client...")
+                    await asyncio.wait_for(client.connect(), timeout=30)
+                self.client = client
+                return True
+
             # Create sessions directory if it doesn't exist and set permissions
             sessions_dir = Path("sessions")
             sessions_dir.mkdir(mode=0o755, exist_ok=True)
@@ -76,6 +219,8 @@ class TelegramUserbot:
                 logger.error("To generate SESSION_STRING, use: https://replit.com/@username/telegram-session-generator")
                 return False
 
+            _CLIENT_CACHE[cache_key] = self.client
+            await self._warm_upload_senders()
             logger.info("Userbot initialized successfully")
             return True
 
@@ -90,6 +235,53 @@ class TelegramUserbot:
 
     async def send_video_to_group(self, file_path, progress_callback=None, max_retries=3):
         """Send video file to specified group with progress tracking and retry mechanism"""
+        # Uploads share one worker, so they run one after another over the same connections
+        if self._upload_worker_task is None or self._upload_worker_task.done():
+            self._upload_worker_task = asyncio.create_task(self._upload_worker())
+        future = asyncio.get_running_loop().create_future()
+        await self._upload_queue.put((file_path, progress_callback, max_retries, future))
+        return await future
+
+    async def _upload_worker(self):
+        """Run queued uploads in order and resolve each caller's future"""
+        while True:
+            file_path, progress_callback, max_retries, future = await self._upload_queue.get()
+            if future.cancelled():
+                continue
+            upload = asyncio.create_task(self._send_video(file_path, progress_callback, max_retries))
+            def cancel_upload(f, upload=upload):
+                # A caller that stops waiting cancels its upload
+                if f.cancelled():
+                    upload.cancel()
+
+            future.add_done_callback(cancel_upload)
+            try:
+                await asyncio.wait([upload])
+            except asyncio.CancelledError:
+                upload.cancel()
+                future.cancel()
+                raise
+            if future.done() or upload.cancelled():
+                continue
+            if upload.exception():
+                future.set_exception(upload.exception())
+            else:
+                future.set_result(upload.result())
+
+    async def _send_video(self, file_path, progress_callback, max_retries):
+        """Upload one video and post it to the group; returns True on success"""
+        # One stat for the whole upload, retries included
+        try:
+            file_stat = os.stat(file_path)
+        except FileNotFoundError:
+            logger.error(f"File not found: {file_path}")
+            self.downloader.release_path(file_path)
+            return False
+        file_size = file_stat.st_size
+        file_name = os.path.basename(file_path)
+        file_mb = file_size / (1024 * 1024)
+        caption = CAPTION_TMPL.format(name=file_name, mb=file_mb)
+
         for attempt in range(max_retries):
             try:
                 # Initialize client if not already done
@@ -98,83 +290,48 @@ class TelegramUserbot:
                         if attempt < max_retries - 1:
                             await asyncio.sleep(2)  # Wait before retry
                             continue
+                        self.downloader.release_path(file_path)
                         return False
 
-                # Check if file exists
-                if not os.path.exists(file_path):
-                    logger.error(f"File not found: {file_path}")
-                    return False
-
-                # Get file info
-                file_size = os.path.getsize(file_path)
-                file_name = os.path.basename(file_path)
-
-                logger.info(f"Sending file: {file_name} ({file_size / (1024*1024):.2f} MB)")
+                logger.info(f"Sending file: {file_name} ({file_mb:.2f} MB)")
 
                 if progress_callback:
                     await progress_callback("📤 Starting video upload...")
 
                 # Create video attributes for proper display
+                duration, width, height = await self._get_video_info(file_path, file_stat)
                 video_attributes = {
-                    'duration': await self._get_video_duration(file_path),
-                    'w': 1280,  # Default width
-                    'h': 720,   # Default height
+                    'duration': duration,
+                    'w': width,
+                    'h': height,
                     'supports_streaming': True
                 }
 
-                # Progress callback for upload with optimized throttling
-                last_upload_update = 0
-                last_percentage = 0
-                import time
-
-                def format_size(bytes_size):
-                    """Format bytes to human readable format"""
-                    for unit in ['B', 'KB', 'MB', 'GB']:
-                        if bytes_size < 1024.0:
-                            return f"{bytes_size:.1f}{unit}"
-                        bytes_size /= 1024.0
-                    return f"{bytes_size:.1f}TB"
-
-                def calculate_speed(current, total, start_time):
-                    """Calculate upload speed"""
-                    elapsed = time.time() - start_time
-                    if elapsed > 0:
-                        speed = current / elapsed
-                        return format_size(speed) + "/s"
-                    return "0B/s"
-
-                upload_start_time = time.time()
-
-                async def upload_progress(current, total):
-                    nonlocal last_upload_update, last_percentage, upload_start_time
-                    current_time = time.time()
-                    percentage = (current / total) * 100
-
-                    # Update every 2 seconds OR every 5% progress for better feedback
-                    if progress_callback and (
-                        (current_time - last_upload_update) >= 2 or 
-                        (percentage - last_percentage) >= 5 or 
-                        current == total
-                    ):
-                        current_str = format_size(current)
-                        total_str = format_size(total)
-                        speed = calculate_speed(current, total, upload_start_time)
-
-                        progress_msg = f"📤 Uploading: {percentage:.1f}%\n💾 Data: {current_str} / {total_str}\n🚄 Speed: {speed}"
-                        
-                        # Use asyncio.create_task to avoid blocking the upload
-                        asyncio.create_task(progress_callback(progress_msg))
-                        last_upload_update = current_time
-                        last_percentage = percentage
+                # Telethon reports progress after every part; the callback only
+                # records the numbers and one publisher task sends them to the chat
+                upload_state = {'current': 0, 'total': file_size, 'done': asyncio.Event()}
 
-                # Send video to group with optimized upload settings
-                from telethon.tl.types import DocumentAttributeVideo
+                def upload_progress(current, total):
+                    upload_state['current'] = current
+                    upload_state['total'] = total
 
-                # Optimize upload with larger chunks and multiple connections
+                publisher = None
+                if progress_callback:
+                    publisher = asyncio.create_task(self._progress_publisher(upload_state, progress_callback))
+
+                # Upload the parts ourselves so big files can use several connections
+                try:
+                    input_file = await self._upload_file(file_path, file_name, file_size, upload_progress)
+                finally:
+                    upload_state['done'].set()
+                    if publisher:
+                        await publisher
+
+                # Send video to group with optimized upload settings
                 await self.client.send_file(
                     entity=self.group_id,
-                    file=file_path,
-                    caption=f"📹 {file_name}\n💾 Size: {file_size / (1024*1024):.2f} MB",
+                    file=input_file,
+                    caption=caption,
                     supports_streaming=True,
                     attributes=[
                         DocumentAttributeVideo(
@@ -184,16 +341,8 @@ class TelegramUserbot:
                             supports_streaming=True
                         )
                     ],
-                    progress_callback=upload_progress,
                     thumb=None,  # Let Telegram generate thumbnail
-                    # Optimization parameters for faster uploads
-                    file_size=file_size,
-                    part_size_kb=512,  # Use 512KB chunks (max allowed)
-                    use_cache=False,   # Don't cache for large files
-                    allow_cache=False, # Disable caching to save memory
-                    max_file_size=2000 * 1024 * 1024,  # 2GB max file size
-                    # Force chunked upload for better speed
-                    force_file=True
+                    file_size=file_size
                 )
 
                 logger.info(f"Video sent successfully to group {self.group_id}")
@@ -202,27 +351,41 @@ class TelegramUserbot:
                     await progress_callback("✅ Upload completed!")
 
                 # Clean up the file after sending
-                self.downloader.cleanup_file(file_path)
+                await self.downloader.cleanup_file_async(file_path)
 
                 return True
 
             except Exception as e:
                 logger.error(f"Upload attempt {attempt + 1} failed: {e}")
                 
+                if isinstance(e, FloodWaitError) and e.seconds > MAX_FLOOD_WAIT:
+                    if progress_callback:
+                        await progress_callback(f"❌ Upload rate limited by Telegram, retry in {e.seconds} s")
+                    await self.downloader.cleanup_file_async(file_path)
+                    return False
+                
                 # Check if it's a temporary error worth retrying
                 if attempt < max_retries - 1:
-                    if any(error in str(e).lower() for error in ['timeout', 'connection', 'network', 'temporary']):
+                    if isinstance(e, FloodWaitError):
+                        # Telegram names the wait; retrying any sooner trips the limit again
+                        delay = e.seconds + random.random()
+                    elif any(error in str(e).lower() for error in ['timeout', 'connection', 'network', 'temporary']):
+                        # Exponential backoff with jitter: ~0.5s, 1s, 2s ... capped at 30s
+                        delay = min(30, 0.5 * 2 ** attempt) + random.random()
+                    else:
+                        delay = None
+
+                    if delay is not None:
                         if progress_callback:
                             await progress_callback(f"🔄 Upload failed, retrying... (attempt {attempt + 2}/{max_retries})")
-                        await asyncio.sleep(3)  # Wait before retry
+                        await asyncio.sleep(delay)
                         
-                        # Try to reconnect the client for network issues
+                        # Heal a dropped connection in place; connect() reuses the auth key
                         try:
-                            if self.client:
-                                await self.client.disconnect()
-                                self.client = None
-                        except:
-                            pass
+                            if self.client and not self.client.is_connected():
+                                await self.client.connect()
+                        except Exception as reconnect_error:
+                            logger.warning(f"Reconnect failed: {reconnect_error}")
                         continue
                 
                 # Final failure after all retries
@@ -230,26 +393,205 @@ class TelegramUserbot:
                     await progress_callback(f"❌ Upload failed after {max_retries} attempts: {str(e)}")
                 
                 # Still try to clean up the file even if sending failed
-                self.downloader.cleanup_file(file_path)
+                await self.downloader.cleanup_file_async(file_path)
                 return False
         
         # If we reach here, all retries failed
-        self.downloader.cleanup_file(file_path)
+        await self.downloader.cleanup_file_async(file_path)
         return False
 
-    async def _get_video_duration(self, file_path):
-        """Get video duration in seconds (fallback method)"""
+    async def _progress_publisher(self, state, progress_callback, interval=2):
+        """Send the latest upload progress every interval seconds until state['done'] is set"""
+        start_time = time.monotonic()
+        published = None
+        while True:
+            try:
+                await asyncio.wait_for(state['done'].wait(), interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+            current, total = state['current'], state['total']
+            if current == published or not total:
+                continue
+
+            percentage = (current / total) * 100
+            speed = format_size(current / (time.monotonic() - start_time)) + "/s"
+            progress_msg = f"📤 Uploading: {percentage:.1f}%\n💾 Data: {format_size(current)} / {format_size(total)}\n🚄 Speed: {speed}"
+            try:
+                await progress_callback(progress_msg)
+            except Exception as e:
+                logger.debug(f"Upload progress callback error: {e}")
+            published = current
+
+    async def _create_upload_sender(self):
+        """Open an extra connection to the account's DC using the session's auth key"""
+        client = self.client
+        dc = await client._get_dc(client.session.dc_id)
+        sender = MTProtoSender(client.session.auth_key, loggers=client._log)
+        await sender.connect(client._connection(
+            dc.ip_address,
+            dc.port,
+            dc.id,
+            loggers=client._log,
+            proxy=client._proxy,
+            local_addr=client._local_addr
+        ))
+        return sender
+
+    async def _take_upload_senders(self, count):
+        """Take count connected upload senders, reusing idle ones before opening new ones"""
+        senders = []
+        while self._upload_senders and len(senders) < count:
+            sender = self._upload_senders.pop()
+            if sender.is_connected():
+                senders.append(sender)
+
+        results = await asyncio.gather(
+            *(self._create_upload_sender() for _ in range(count - len(senders))),
+            return_exceptions=True
+        )
+        senders.extend(result for result in results if not isinstance(result, BaseException))
+        if len(senders) < count:
+            self._upload_senders.extend(senders)
+            raise next(result for result in results if isinstance(result, BaseException))
+        return senders
+
+    async def _warm_upload_senders(self):
+        """Connect the upload senders ahead of the first upload"""
         try:
-            # Simple duration detection based on file size (rough estimate)
-            file_size = os.path.getsize(file_path)
-            # Assume average bitrate of 1 Mbps for estimation
-            estimated_duration = max(10, min(3600, file_size // (125000)))  # 10 sec to 1 hour
-            return int(estimated_duration)
-        except:
-            return 60  # Default 1 minute
-
-    async def disconnect(self):
-        """Disconnect the client"""
-        if self.client:
-            await self.client.disconnect()
-            logger.info("Userbot disconnected")
+            self._upload_senders.extend(await self._take_upload_senders(UPLOAD_WORKERS))
+        except Exception as e:
+            logger.warning(f"Could not open upload connections in advance: {e}")
+
+    async def _upload_file(self, file_path, file_name, file_size, progress_callback=None):
+        """Upload a file and return the InputFile to send"""
+        try:
+            return await self._upload_file_parts(file_path, file_name, file_size, progress_callback)
+        except Exception as e:
+            logger.warning(f"Upload over dedicated connections failed, retrying on the main one: {e}")
+
+        async with aiofiles.open(file_path, 'rb') as af:
+            return await self.client.upload_file(
+                af,
+                part_size_kb=UPLOAD_PART_SIZE // 1024,
+                file_size=file_size,
+                file_name=file_name,
+                progress_callback=progress_callback
+            )
+
+    async def _upload_file_parts(self, file_path, file_name, file_size, progress_callback=None):
+        """Send the file's parts over the upload senders, UPLOAD_WORKERS at once for big files"""
+        file_id = generate_random_long()
+        part_count = -(-file_size // UPLOAD_PART_SIZE)
+        is_big = file_size > BIG_FILE_SIZE
+        # Small files need an MD5 of the parts in order, so they go over one connection
+        md5 = None if is_big else hashlib.md5()
+        # Workers pull the next free part, so one slow connection doesn't hold back the rest
+        parts = iter(range(part_count))
+        uploaded = 0
+
+        async def upload_parts(sender):
+            nonlocal uploaded
+            # Own handle per worker, read off the loop so disk IO overlaps the other sends
+            async with aiofiles.open(file_path, 'rb') as af:
+                for part_index in parts:
+                    await af.seek(part_index * UPLOAD_PART_SIZE)
+                    part = await af.read(UPLOAD_PART_SIZE)
+                    if is_big:
+                        request = SaveBigFilePartRequest(file_id, part_index, part_count, part)
+                    else:
+                        md5.update(part)
+                        request = SaveFilePartRequest(file_id, part_index, part)
+                    if not await sender.send(request):
+                        raise RuntimeError(f"Failed to upload file part {part_index}")
+                    uploaded += len(part)
+                    if progress_callback:
+                        progress_callback(uploaded, file_size)
+
+        # Dedicated senders keep the client's main connection free for updates and messages
+        senders = await self._take_upload_senders(UPLOAD_WORKERS if is_big else 1)
+        healthy = False
+        try:
+            logger.info(f"Uploading {part_count} parts over {len(senders)} connections")
+            tasks = [asyncio.create_task(upload_parts(sender)) for sender in senders]
+            try:
+                await asyncio.gather(*tasks)
+                healthy = True
+            finally:
+                # One failed part fails the upload; stop the other workers
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # Keep the connections for the next upload unless something went wrong on them
+            if healthy:
+                self._upload_senders.extend(senders)
+            else:
+                await asyncio.gather(*(sender.disconnect() for sender in senders), return_exceptions=True)
+
+        if is_big:
+            return InputFileBig(file_id, part_count, file_name)
+        return InputFile(file_id, part_count, file_name, md5.hexdigest())
+
+    async def _get_video_info(self, file_path, file_stat):
+        """Get (duration, width, height) from the container, estimating what can't be read"""
+        duration, width, height = 0, None, None
+        # Plain mp4 headers are parsed directly, which saves spawning ffprobe
+        try:
+            async with aiofiles.open(file_path, 'rb') as af:
+                info = await _probe_mp4(af, file_stat.st_size)
+            if info:
+                duration, width, height = info
+        except (OSError, IndexError, struct.error) as e:
+            logger.warning(f"Could not parse mp4 header of {file_path}: {e}")
+
+        if not (duration and width and height) and find_tool('ffprobe'):
+            try:
+                duration, width, height = await asyncio.to_thread(
+                    _ffprobe_video, file_path, file_stat.st_mtime_ns
+                )
+            except (OSError, ValueError, subprocess.SubprocessError) as e:
+                logger.warning(f"ffprobe could not read {file_path}: {e}")
+
+        if not duration:
+            duration = await self._get_video_duration(file_path, file_stat.st_size)
+        return duration, width or DEFAULT_VIDEO_WIDTH, height or DEFAULT_VIDEO_HEIGHT
+
+    async def _get_video_duration(self, file_path, file_size):
+        """Get video duration in seconds (fallback method)"""
+        # Simple duration detection based on file size (rough estimate)
+        # Assume average bitrate of 1 Mbps for estimation
+        estimated_duration = max(10, min(3600, file_size // (125000)))  # 10 sec to 1 hour
+        return int(estimated_duration)
+
+    async def disconnect(self, shutdown=False):
+        """Disconnect the client; it is kept connected for reuse unless shutdown=True"""
+        if not shutdown:
+            return
+        if self._upload_worker_task:
+            self._upload_worker_task.cancel()
+            await asyncio.gather(self._upload_worker_task, return_exceptions=True)
+            self._upload_worker_task = None
+        while not self._upload_queue.empty():
+            self._upload_queue.get_nowait()[-1].cancel()
+        if not self.client:
+            return
+        _CLIENT_CACHE.pop((self.api_id, self.session_string or ''), None)
+        senders, self._upload_senders = self._upload_senders, []
+        await asyncio.gather(*(sender.disconnect() for sender in senders), return_exceptions=True)
+        await self.client.disconnect()
+        self.client = None
+        logger.info("Userbot disconnected")
+
+# The process-wide userbot, created by get_userbot()
+_USERBOT = None
+
+async def get_userbot(downloader=None):
+    """Return the shared TelegramUserbot, connecting it on first use"""
+    global _USERBOT
+    if _USERBOT is None:
+        _USERBOT = TelegramUserbot(downloader=downloader)
+    if not _USERBOT.client:
+        await _USERBOT.initialize_client()
+    return _USERBOT